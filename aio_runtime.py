@@ -0,0 +1,163 @@
+import asyncio
+import functools
+import queue
+import threading
+import scheduler
+import utils
+import metrics
+import file_transfer
+from network import create_socket, decode_datagram
+
+PING_INTERVAL = 300  # seconds between periodic PINGs
+
+# scheduler jobs that have a coroutine version; the rest (hashing an offer,
+# the group broadcast loop) still block, so they run in the default executor
+ASYNC_JOBS = {
+    file_transfer.send_file_chunks: file_transfer.send_file_chunks_async,
+}
+
+class LoopSocket:
+    """the part of the socket api the senders use, backed by a datagram transport.
+
+    sends from the loop thread go straight out, sends from executor threads are
+    handed to the loop, so the transport is only ever touched by one thread
+    """
+    def __init__(self, loop, transport, sock):
+        self.loop = loop
+        self.transport = transport
+        self.sock = sock
+        self.thread = threading.get_ident()
+
+    def sendto(self, data, addr):
+        if threading.get_ident() == self.thread:
+            self.transport.sendto(data, addr)
+        else:
+            self.loop.call_soon_threadsafe(self.transport.sendto, bytes(data), addr)
+
+    def sendmsg(self, buffers, ancdata, flags, addr):
+        # scatter-gather only while nothing is queued in the transport, so the
+        # order of datagrams is kept and a full buffer falls back to a copy
+        if threading.get_ident() == self.thread and not self.transport.get_write_buffer_size():
+            try:
+                return self.sock.sendmsg(buffers, ancdata, flags, addr)
+            except (BlockingIOError, InterruptedError):
+                pass
+        self.sendto(b''.join(buffers), addr)
+
+    def getsockopt(self, *opt):
+        return self.sock.getsockopt(*opt)
+
+class PeerProtocol(asyncio.DatagramProtocol):
+    """runs every incoming datagram's handler on the loop thread"""
+    def __init__(self, handler, verbose=False):
+        self.handler = handler
+        self.verbose = verbose
+        self.received = 0
+        self.errors = 0
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        metrics.count('in', data)
+        try:
+            self.handler(decode_datagram(data), addr)
+        except Exception as e:
+            self.errors += 1
+            if self.verbose:
+                utils.log(f"Error handling datagram from {addr[0]}: {e}", "ERROR")
+
+    def error_received(self, exc):
+        if self.verbose:
+            utils.log(f"Socket error: {exc}", "ERROR")
+
+class JobPool:
+    """runs scheduler jobs as tasks, at most `workers` at a time, smaller jobs first"""
+    def __init__(self, loop, workers):
+        self.loop = loop
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [loop.create_task(self._worker()) for _ in range(workers)]
+
+    def submit(self, priority, job, func, args):
+        # may be called from an executor thread
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (priority, job.id, job, func, args))
+
+    async def _worker(self):
+        while True:
+            _, _, job, func, args = await self.queue.get()
+            scheduler.job_started(job)
+            try:
+                if func in ASYNC_JOBS:
+                    ok = await ASYNC_JOBS[func](*args, job=job)
+                else:
+                    ok = await self.loop.run_in_executor(None, functools.partial(func, *args, job=job))
+                scheduler.job_finished(job, ok)
+            except Exception as e:
+                scheduler.job_finished(job, False, e)
+
+class StdinReader:
+    """reads input lines on a daemon thread, one per request so the prompt
+    only shows up after the previous command's output"""
+    def __init__(self, loop):
+        self.loop = loop
+        self.requests = queue.Queue()
+        self.lines = asyncio.Queue()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    async def readline(self, prompt):
+        """next line without the newline, None at end of input"""
+        self.requests.put(prompt)
+        return await self.lines.get()
+
+    def _read(self):
+        while True:
+            prompt = self.requests.get()
+            try:
+                line = input(prompt)
+            except EOFError:
+                line = None
+            self.loop.call_soon_threadsafe(self.lines.put_nowait, line)
+
+async def ping_timer(sock, on_ping):
+    while True:
+        await asyncio.sleep(PING_INTERVAL)
+        on_ping(sock)
+
+async def _run(args, on_message, on_command, on_start, on_ping):
+    loop = asyncio.get_running_loop()
+    raw_sock = create_socket(args.rcvbuf * 1024)
+    sock = None
+    protocol = PeerProtocol(lambda raw, addr: on_message(raw, addr, sock, args), args.verbose)
+    transport, _ = await loop.create_datagram_endpoint(lambda: protocol, sock=raw_sock)
+    sock = LoopSocket(loop, transport, raw_sock)
+
+    pool = JobPool(loop, scheduler.workers)
+    scheduler.set_runner(pool.submit)
+    ping_task = loop.create_task(ping_timer(sock, on_ping))
+    stdin = StdinReader(loop)
+
+    try:
+        on_start(sock, args, protocol)
+        print("[LSNP] Peer is running (asyncio). Type 'post <msg>' or 'dm <to> <msg>' or 'quit'")
+        while True:
+            line = await stdin.readline("> ")
+            if line is None:
+                break
+            try:
+                if on_command(line.strip(), sock, args, protocol) is False:
+                    break
+            except Exception as e:
+                print(f"An error occurred: {e}")
+    finally:
+        ping_task.cancel()
+        for task in pool.tasks:
+            task.cancel()
+        scheduler.set_runner(None)
+        transport.close()
+
+def run(args, on_message, on_command, on_start, on_ping):
+    """runs the peer on one asyncio loop: on_message(raw, addr, sock, args) per
+    datagram, on_command(cmd, sock, args, protocol) per input line, False quits,
+    and on_start(sock, args, protocol) once the socket is up"""
+    try:
+        asyncio.run(_run(args, on_message, on_command, on_start, on_ping))
+    except KeyboardInterrupt:
+        pass
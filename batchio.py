@@ -0,0 +1,203 @@
+import ctypes
+import functools
+import itertools
+import os
+import errno
+import socket
+import struct
+import sys
+
+MAX_BATCH = 64          # datagrams per sendmmsg / recvmmsg call
+RECV_AREA = 1 << 20     # receive buffers past this fall out of cache and cost more than the syscalls saved
+MSG_WAITFORONE = 0x10000
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+SOCKADDR_IN = struct.Struct('=H2s4s8x')  # family (host order), port, addr, padding
+
+def _packer(ctype, codes):
+    # a struct.Struct that lays out ctype's fields like the compiler does, so a
+    # whole batch of them can be packed into one bytearray without ctypes objects
+    fmt, end = '@', 0
+    for (name, _), code in zip(ctype._fields_, codes):
+        offset = getattr(ctype, name).offset
+        fmt += f'{offset - end}x{code}'
+        end = offset + struct.calcsize('@' + code)
+    return struct.Struct(fmt + f'{ctypes.sizeof(ctype) - end}x')
+
+IOVEC = _packer(iovec, 'PN')
+MMSGHDR = _packer(mmsghdr, (_packer(msghdr, 'PIPNPNi').format[1:], 'I'))
+MMSGHDR_SIZE = ctypes.sizeof(mmsghdr)
+MSG_LEN = _packer(mmsghdr, (f'{ctypes.sizeof(msghdr)}x', 'I'))  # just the length recvmmsg fills in
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        for name in ('sendmmsg', 'recvmmsg'):
+            func = getattr(libc, name)
+            func.restype = ctypes.c_int
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+_libc = _load_libc()
+AVAILABLE = _libc is not None
+
+@functools.lru_cache(maxsize=1024)
+def _sockaddr(addr):
+    # (buffer, its address), cached so the buffer outlives every send using it
+    ip, port = addr
+    host = '255.255.255.255' if ip == '<broadcast>' else socket.gethostbyname(ip)
+    name = ctypes.create_string_buffer(
+        SOCKADDR_IN.pack(socket.AF_INET, struct.pack('!H', port), socket.inet_aton(host)), SOCKADDR_IN.size)
+    return name, ctypes.addressof(name)
+
+@functools.lru_cache(maxsize=1024)
+def _peer(port, ip):
+    return socket.inet_ntoa(ip), struct.unpack('!H', port)[0]
+
+@functools.lru_cache(maxsize=None)
+def _table(packer, count):
+    # one Struct for count packed in a row, so a whole batch is a single pack_into
+    return struct.Struct('@' + packer.format[1:] * count)
+
+def _address(buf, keep):
+    # address of buf's data without copying where possible, keep holds what must stay alive
+    if type(buf) is bytes:
+        # c_char_p points at the bytes' own data and keeps the object alive
+        pointer = ctypes.c_char_p(buf)
+        keep.append(pointer)
+        return ctypes.c_void_p.from_buffer(pointer).value  # cheaper than ctypes.cast
+    try:
+        # a one byte view is enough for the address and costs less to make
+        first = ctypes.c_char.from_buffer(buf)
+    except TypeError:  # read-only
+        return _address(bytes(buf), keep)
+    except ValueError:  # empty
+        return 0
+    keep.append(first)
+    return ctypes.addressof(first)
+
+def batches(items, size=MAX_BATCH):
+    """splits a sequence or iterable into lists of at most size items"""
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+def send_each(sock, datagrams):
+    """sends [(buffers, (ip, port)), ...] with one sendmsg (or sendto) per datagram"""
+    for buffers, addr in datagrams:
+        if hasattr(sock, 'sendmsg'):
+            sock.sendmsg(buffers, [], 0, addr)
+        else:
+            sock.sendto(b''.join(buffers), addr)
+
+def send_batch(sock, datagrams):
+    """send_each with one sendmmsg per MAX_BATCH datagrams.
+
+    each datagram is gathered from its list of buffers (bytes or writable
+    memoryviews). falls back to send_each where sendmmsg isn't available,
+    or the socket isn't a real one
+    """
+    if not AVAILABLE or not isinstance(sock, socket.socket):
+        send_each(sock, datagrams)
+        return
+    fd = sock.fileno()
+    for batch in batches(datagrams):
+        # the headers and iovecs are packed into two bytearrays, building
+        # ctypes structures one field at a time costs more than the syscall
+        iovs = bytearray(IOVEC.size * sum(len(buffers) for buffers, _ in batch))
+        iovs_array = (ctypes.c_char * len(iovs)).from_buffer(iovs)
+        iov_at = ctypes.addressof(iovs_array)
+        iov_values = []
+        msg_values = []
+        keep = []  # what the addresses in iovs point into, alive until sent
+        for buffers, addr in batch:
+            msg_values += (_sockaddr(addr)[1], SOCKADDR_IN.size, iov_at, len(buffers), 0, 0, 0, 0)
+            iov_at += IOVEC.size * len(buffers)
+            for buf in buffers:
+                iov_values += (_address(buf, keep), len(buf))
+        _table(IOVEC, len(iov_values) // 2).pack_into(iovs, 0, *iov_values)
+        msgs = _table(MMSGHDR, len(batch)).pack(*msg_values)
+        msgs_array = ctypes.create_string_buffer(msgs, len(msgs))
+        sent = 0
+        while sent < len(batch):
+            count = _libc.sendmmsg(fd, ctypes.byref(msgs_array, sent * MMSGHDR_SIZE), len(batch) - sent, 0)
+            if count < 0:
+                if ctypes.get_errno() == errno.EINTR:
+                    continue
+                _raise_errno()
+            sent += count
+        # drop the buffer exports now, so a caller can close an mmap right after
+        del keep, iovs_array
+
+class BatchReceiver:
+    """drains up to MAX_BATCH waiting datagrams per recvmmsg call, blocking only for the first"""
+    def __init__(self, sock, size, count=None):
+        self.sock = sock
+        self.size = size
+        if not AVAILABLE:
+            return
+        if count is None:
+            count = max(1, min(MAX_BATCH, RECV_AREA // size))
+        # every buffer and header lives in a few bytearrays set up once, and
+        # what the kernel fills in is read back with one unpack per call
+        self.data = bytearray(size * count)
+        self.view = memoryview(self.data)
+        self.names = bytearray(SOCKADDR_IN.size * count)
+        self.keep = []
+        data_at = _address(self.data, self.keep)
+        names_at = _address(self.names, self.keep)
+        self.iovs = bytearray(_table(IOVEC, count).pack(
+            *[v for i in range(count) for v in (data_at + i * size, size)]))
+        iovs_at = _address(self.iovs, self.keep)
+        # msg_namelen is set once: the kernel writes back the length of an
+        # AF_INET address, which is what it starts as
+        self.msgs = bytearray(_table(MMSGHDR, count).pack(
+            *[v for i in range(count) for v in (names_at + i * SOCKADDR_IN.size, SOCKADDR_IN.size,
+                                                 iovs_at + i * IOVEC.size, 1, 0, 0, 0, 0)]))
+        self.msgs_at = _address(self.msgs, self.keep)
+        self.count = count
+
+    def recv(self):
+        """yields (data, (ip, port)) for at least one datagram.
+
+        each is copied out as it's taken, so a large batch never holds every
+        copy at once; take them all before calling recv again
+        """
+        if not AVAILABLE:
+            yield self.sock.recvfrom(self.size)
+            return
+        while True:
+            count = _libc.recvmmsg(self.sock.fileno(), self.msgs_at, self.count, MSG_WAITFORONE, None)
+            if count >= 0:
+                break
+            if ctypes.get_errno() != errno.EINTR:
+                _raise_errno()
+        lengths = _table(MSG_LEN, count).unpack_from(self.msgs)
+        names = _table(SOCKADDR_IN, count).unpack_from(self.names)
+        size = self.size
+        view = self.view
+        for i, length in enumerate(lengths):
+            yield view[i * size:i * size + length].tobytes(), _peer(names[3 * i + 1], names[3 * i + 2])
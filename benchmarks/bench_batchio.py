@@ -0,0 +1,104 @@
+"""loopback throughput of one syscall per datagram against sendmmsg/recvmmsg batches.
+
+the receiver is a separate process, like a real peer. payloads under 8 KiB
+are bytes like text chunks, larger ones are writable views like mmap slices;
+batchio makes a ctypes pointer to every buffer either way. the peer only
+sends in batches with --batch-send, see network.set_batch_send.
+
+run from the repo root: python benchmarks/bench_batchio.py
+"""
+import os
+import socket
+import struct
+import sys
+import multiprocessing
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import batchio
+from parser import chunk_frame_header
+
+DATAGRAMS = 100000
+REPEATS = 3
+IDLE = 0.2  # seconds without a datagram before the receiver stops
+
+def receiver_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    # SO_RCVTIMEO rather than settimeout, which would make recvmmsg non-blocking
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('ll', 0, int(IDLE * 1e6)))
+    sock.bind(('127.0.0.1', 0))
+    return sock
+
+def receive_single(sock):
+    # (datagrams received, when the last one came in)
+    count = last = 0
+    while True:
+        try:
+            sock.recvfrom(65535)
+        except OSError:
+            return count, last
+        count += 1
+        last = time.perf_counter()
+
+def receive_batched(sock):
+    receiver = batchio.BatchReceiver(sock, 65535)
+    count = last = 0
+    while True:
+        try:
+            for _ in receiver.recv():
+                count += 1
+        except OSError:
+            return count, last
+        last = time.perf_counter()
+
+def receiver(receive, ready, results):
+    # its own process, like a real peer, so the two sides don't share a GIL
+    sock = receiver_socket()
+    ready.send(sock.getsockname())
+    results.send(receive(sock))
+
+def send_single(sock, datagrams):
+    for buffers, addr in datagrams:
+        sock.sendmsg(buffers, [], 0, addr)
+
+def send_batched(sock, datagrams):
+    batchio.send_batch(sock, datagrams)
+
+def run(send, receive, size):
+    ready, ready_end = multiprocessing.Pipe()
+    results, results_end = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=receiver, args=(receive, ready_end, results_end))
+    process.start()
+    addr = ready.recv()
+    ssock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # text chunks are bytes, binary chunks are slices of a writable mmap
+    payload = os.urandom(size) if size < 8192 else memoryview(bytearray(os.urandom(size)))[:size]
+    datagrams = [([chunk_frame_header('a1b2c3d4', i, DATAGRAMS, 0), payload], addr) for i in range(DATAGRAMS)]
+    start = time.perf_counter()
+    send(ssock, datagrams)
+    sent = time.perf_counter() - start
+    count, finished = results.recv()
+    process.join()
+    ssock.close()
+    # perf_counter is system wide on linux, so the receiver's clock lines up
+    received = finished - start
+    return DATAGRAMS / sent, count / received, count / DATAGRAMS
+
+def main():
+    if not batchio.AVAILABLE:
+        print("sendmmsg/recvmmsg not available here, both rows would measure the fallback")
+    print(f"{'payload':>8} {'mode':<10}{'sent pkt/s':>14}{'recv pkt/s':>14}{'delivered':>11}")
+    modes = (("single", send_single, receive_single), ("batched", send_batched, receive_batched))
+    for size in (64, 1024, 8192, 32768):
+        # alternate the two modes and keep each one's best run, to ride out noise
+        best = {}
+        for _ in range(REPEATS):
+            for mode, send, receive in modes:
+                best[mode] = max(best.get(mode, (0, 0, 0)), run(send, receive, size), key=lambda r: r[1])
+        for mode, _, _ in modes:
+            sent, received, delivered = best[mode]
+            print(f"{size:>8} {mode:<10}{sent:>14,.0f}{received:>14,.0f}{delivered:>10.1%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""packets per second of parse_message, against the old split-everything parser.
+
+run from the repo root: python benchmarks/bench_parser.py
+"""
+import base64
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parser import build_message, parse_message, peek
+
+def parse_message_split(raw):
+    # parse_message before it found DATA first
+    lines = raw.strip().split('\n')
+    msg = {}
+    for line in lines:
+        if ':' not in line:
+            continue
+        k, v = line.split(':', 1)
+        msg[k.strip()] = v.strip()
+    return msg
+
+def chunk_message(size):
+    return build_message({
+        "TYPE": "FILE_CHUNK",
+        "FROM": "alice@192.168.1.10",
+        "TO": "bob@192.168.1.11",
+        "FILEID": "a1b2c3d4",
+        "CHUNK_INDEX": 42,
+        "TOTAL_CHUNKS": 1000,
+        "CHUNK_SIZE": size,
+        "CRC32": 123456789,
+        "TOKEN": "alice@192.168.1.10|1700000000|file",
+        "DATA": base64.b64encode(os.urandom(size)).decode('ascii'),
+    })
+
+POST = build_message({
+    "TYPE": "POST",
+    "USER_ID": "alice@192.168.1.10",
+    "CONTENT": "hello everyone, this is a short post",
+    "TTL": 3600,
+    "MESSAGE_ID": "f00dbabe",
+    "TOKEN": "alice@192.168.1.10|1700000000|broadcast",
+})
+
+def drop_self(parse, raw):
+    # what handle_message did with its own broadcasts
+    msg = parse(raw)
+    return msg.get("TYPE"), msg.get("USER_ID") or msg.get("FROM")
+
+def drop_self_peek(parse, raw):
+    # what it does now: the first two lines are enough, parse is the fallback
+    head = peek(raw)
+    if head is not None:
+        return head
+    return drop_self(parse, raw)
+
+def handle_chunk(parse, raw):
+    # dispatch, then the fields handle_file_chunk reads
+    msg = parse(raw)
+    msg.get("TYPE"), msg.get("USER_ID") or msg.get("FROM")
+    return (msg.get("FILEID"), int(msg.get("CHUNK_INDEX")), int(msg.get("TOTAL_CHUNKS")),
+            msg.get("CRC32"), msg.get("DATA"))
+
+def every_field(parse, raw):
+    return dict(parse(raw))
+
+def rate(func, parse, raw, seconds=0.2):
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(200):
+            func(parse, raw)
+        count += 200
+    return count / (time.perf_counter() - start)
+
+def best_rates(func, new_func, raw, repeats=5):
+    # alternate the two parsers and keep each one's best run, to ride out noise
+    before = after = 0.0
+    for _ in range(repeats):
+        before = max(before, rate(func, parse_message_split, raw))
+        after = max(after, rate(new_func, parse_message, raw))
+    return before, after
+
+def main():
+    cases = [
+        ("drop own POST", drop_self, drop_self_peek, POST),
+        ("drop own 1.4 KB chunk", drop_self, drop_self_peek, chunk_message(1024)),
+        ("handle 1.4 KB chunk", handle_chunk, handle_chunk, chunk_message(1024)),
+        ("drop own 63 KB chunk", drop_self, drop_self_peek, chunk_message(46 * 1024)),
+        ("handle 63 KB chunk", handle_chunk, handle_chunk, chunk_message(46 * 1024)),
+        ("every field of a POST", every_field, every_field, POST),
+    ]
+    print(f"{'case':<24}{'old pkt/s':>14}{'new pkt/s':>16}{'speedup':>10}")
+    for name, func, new_func, raw in cases:
+        before, after = best_rates(func, new_func, raw)
+        print(f"{name:<24}{before:>14,.0f}{after:>16,.0f}{after / before:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
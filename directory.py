@@ -0,0 +1,115 @@
+import functools
+import socket
+import time
+import state
+import retention
+from network import reliable, UDP_PORT
+from parser import MessageTemplate
+
+PEER_TTL = 900       # a peer not heard from for three PING rounds has left
+GONE_TTL = 24 * 3600 # how long a departed peer is remembered as such
+STATUS = "Exploring LSNP!"
+PING_REPLY_WINDOW = 5  # seconds a peer's first PROFILE counts as the answer to our PING
+
+class Peer:
+    """what the directory knows about a peer, updated by every message it sends"""
+    __slots__ = ('user_id', 'display', 'status', 'addr', 'last_seen')
+
+    def __init__(self, user_id, addr):
+        self.user_id = user_id
+        self.display = user_id
+        self.status = ""
+        self.addr = addr
+        self.last_seen = time.time()
+
+    @property
+    def rtt(self):
+        # from acks of reliable messages and PROFILEs answering our PINGs, None until one came back
+        estimator = reliable.peers.get(self.addr)
+        return estimator.srtt if estimator is not None else None
+
+ports = {}  # USER_ID -> port, for peers not on UDP_PORT we haven't heard from yet
+ping_sent = None  # when our last PING went out
+_answered = set() # peers whose PROFILE since then was already taken as the answer
+
+@functools.lru_cache(maxsize=4096)
+def _resolve(user_id):
+    # the host part of user@host, checked and resolved once instead of on every send
+    user, _, host = user_id.rpartition('@')
+    if user:
+        try:
+            return socket.gethostbyname(host)
+        except OSError:
+            pass
+    raise ValueError(f"'{user_id}' is not a user@ip id")
+
+def address(user_id):
+    """(ip, port) to send to user_id: where it last sent from, else the ip in its id.
+
+    the learned address also covers a peer behind NAT or on another port
+    """
+    peer = state.peers.get(user_id)
+    if peer is not None:
+        return peer.addr
+    return (_resolve(user_id), ports.get(user_id, UDP_PORT))
+
+def seen(user_id, addr):
+    """records that user_id just sent something from addr"""
+    peer = state.peers.get(user_id)
+    if peer is None:
+        new = Peer(user_id, addr)
+        peer = state.peers.setdefault(user_id, new)
+        if peer is new:
+            state.gone.pop(user_id, None)
+            retention.wheel.schedule(PEER_TTL, _sweep, user_id, peer)
+            return peer
+    peer.last_seen = time.time()
+    peer.addr = addr
+    return peer
+
+def pinged():
+    """records that a PING just went out, the PROFILEs answering it time the round trip"""
+    global ping_sent
+    _answered.clear()
+    ping_sent = time.time()
+
+def answered(user_id, addr):
+    """a PROFILE came from user_id at addr; the first one soon after our PING is an rtt sample.
+    a PROFILE the peer broadcast on its own right then is taken for one too, rarely enough"""
+    if ping_sent is None or user_id in _answered:
+        return
+    elapsed = time.time() - ping_sent
+    if elapsed <= PING_REPLY_WINDOW:
+        _answered.add(user_id)
+        reliable.rtt_sample(addr, elapsed)
+
+def _sweep(user_id, peer):
+    # the peer's one timer: put off while it keeps talking, otherwise it's gone
+    with state.peers.lock(user_id):
+        if state.peers.get(user_id) is not peer:
+            return
+        idle = time.time() - peer.last_seen
+        if idle < PEER_TTL:
+            retention.wheel.schedule(PEER_TTL - idle, _sweep, user_id, peer)
+            return
+        del state.peers[user_id]
+        state.gone[user_id] = peer.last_seen
+    retention.expire(state.gone, user_id, GONE_TTL, 'departed peers')
+    retention.count('peers swept')
+
+def is_gone(user_id):
+    """True for a peer that was here and stopped answering, not for one never heard from"""
+    return user_id in state.gone
+
+def display_name(user_id):
+    peer = state.peers.get(user_id)
+    return peer.display if peer is not None else user_id
+
+@functools.lru_cache(maxsize=None)
+def profile_message(user_id, display_name):
+    return MessageTemplate({
+        "TYPE": "PROFILE",
+        "USER_ID": user_id,
+        "DISPLAY_NAME": display_name,
+        "STATUS": STATUS,
+    }).render()
@@ -1,59 +1,318 @@
 import os
+import asyncio
 import base64
+import functools
+import mmap
 import mimetypes
 import uuid
 import time
 import threading
+from collections import deque
 import state
 import utils
-from network import send_message
-from parser import build_message
+import retention
+import directory
+import scheduler
+import batchio
+import metrics
+from network import send_message, send_frame, send_frames, RttEstimator, MAX_DATAGRAM
+from parser import build_message, chunk_frame_header, parse_chunk_frame, CHUNK_FRAME, MessageTemplate
+from storage import ChunkBitmap, PartialFile, file_digests, save_progress, remove_progress, find_progress
+from storage import chunk_cache, lookup_content, record_content
+from integrity import TreeHasher, LEAF_SIZE, crc32, num_leaves
+from registry import register
 
-CHUNK_DATA_SIZE = 1024
+CHUNK_DATA_SIZE = 1024  # used when the peer does not negotiate a chunk size
+CHUNK_ALIGN = LEAF_SIZE  # chunks hold whole tree hash leaves
+# largest payloads that still fit one datagram, kept to whole KiB
+MAX_BINARY_CHUNK = (MAX_DATAGRAM - CHUNK_FRAME.size) // CHUNK_ALIGN * CHUNK_ALIGN
+MAX_TEXT_CHUNK = (MAX_DATAGRAM - 1024) // 4 * 3 // CHUNK_ALIGN * CHUNK_ALIGN  # base64 + headers
+PROGRESS_SAVE_INTERVAL = 1.0  # seconds between sidecar updates of a download
+INITIAL_WINDOW = 4      # chunks in flight before the first ack arrives
+MAX_WINDOW = 1024
+MAX_RETRIES = 10        # per chunk, before the transfer is abandoned
+REORDER_THRESHOLD = 3   # later chunks acked before a chunk is presumed lost
+
+class SendWindow:
+    """sliding window of in-flight chunks for one outgoing transfer"""
+    def __init__(self, total_chunks, ranges=None):
+        self.total_chunks = total_chunks
+        if ranges is None:
+            ranges = [(0, total_chunks)]
+        # 1 = chunk still has to be delivered, 0 = acked or not part of this send
+        self.needed = bytearray(total_chunks)
+        for start, end in ranges:
+            self.needed[start:end] = b'\x01' * (end - start)
+        self.remaining = sum(end - start for start, end in ranges)
+        self.fresh = (i for start, end in ranges for i in range(start, end))
+        self.retransmit = deque()
+        self.in_flight = {}     # index -> (sent_at, retries, seq), kept in send order
+        self.seq = 0
+        self.retries = {}       # index -> times resent so far
+        self.cwnd = float(INITIAL_WINDOW)
+        self.ssthresh = float(MAX_WINDOW)
+        self.last_loss = 0.0
+        self.rtt = RttEstimator()
+        self.acked_upto = 0
+        self.failed = False
+        self.cond = threading.Condition()
+        self.waker = None       # extra callback on acks, for senders not blocked in wait()
+
+    @property
+    def done(self):
+        return self.remaining == 0
+
+    def poll(self):
+        """returns the chunk indices that should go out now"""
+        now = time.time()
+        with self.cond:
+            # chunks whose ack did not come back in time
+            expired = [i for i, (sent_at, _, _) in self.in_flight.items() if now - sent_at > self.rtt.rto]
+            if expired:
+                self._on_loss(now)
+                for i in expired:
+                    del self.in_flight[i]
+                    self.retransmit.append(i)
+
+            to_send = []
+            while len(self.in_flight) < int(self.cwnd):
+                if self.retransmit:
+                    index = self.retransmit.popleft()
+                    if not self.needed[index] or index in self.in_flight:
+                        continue
+                    self.retries[index] = self.retries.get(index, 0) + 1
+                    metrics.event('chunks resent')
+                    if self.retries[index] > MAX_RETRIES:
+                        self.failed = True
+                        break
+                else:
+                    index = next(self.fresh, None)
+                    if index is None:
+                        break
+                self.in_flight[index] = (now, self.retries.get(index, 0), self.seq)
+                self.seq += 1
+                to_send.append(index)
+            return to_send
+
+    def stamp(self, index):
+        """restarts a chunk's timer once it actually leaves, after any rate limiting"""
+        with self.cond:
+            entry = self.in_flight.get(index)
+            if entry:
+                self.in_flight[index] = (time.time(), entry[1], entry[2])
+
+    def on_ack(self, index, upto=0):
+        with self.cond:
+            entry = self.in_flight.pop(index, None)
+            # karn: an ack for a resent chunk may answer any of its copies, so
+            # neither its rtt nor its seq says anything about this send
+            if entry and entry[1] == 0:
+                self.rtt.sample(time.time() - entry[0])
+                self._detect_reordered_loss(entry[2])
+            newly_acked = self._mark_acked(index)
+            # cumulative ack covers anything whose own ack got lost
+            while self.acked_upto < min(upto, self.total_chunks):
+                newly_acked += self._mark_acked(self.acked_upto)
+                self.in_flight.pop(self.acked_upto, None)
+                self.acked_upto += 1
+            for _ in range(newly_acked):
+                if self.cwnd < self.ssthresh:
+                    self.cwnd += 1
+                else:
+                    self.cwnd += 1 / self.cwnd
+            self.cwnd = min(self.cwnd, MAX_WINDOW)
+            self.cond.notify_all()
+        if self.waker:
+            self.waker()
+
+    def on_nack(self, ranges):
+        """resends chunks the receiver reported damaged, ahead of anything else"""
+        with self.cond:
+            for start, end in ranges:
+                for index in range(start, end):
+                    if 0 <= index < self.total_chunks and self.needed[index]:
+                        self.in_flight.pop(index, None)
+                        self.retransmit.appendleft(index)
+            self.cond.notify_all()
+        if self.waker:
+            self.waker()
+
+    def finish(self):
+        """receiver confirmed the whole file, stop sending"""
+        with self.cond:
+            self.needed = bytearray(self.total_chunks)
+            self.remaining = 0
+            self.in_flight.clear()
+            self.cond.notify_all()
+        if self.waker:
+            self.waker()
+
+    def next_timeout(self):
+        """seconds until the oldest in-flight chunk times out, None if nothing is in flight"""
+        with self.cond:
+            if self.done or self.failed or not self.in_flight:
+                return None
+            oldest = min(sent_at for sent_at, _, _ in self.in_flight.values())
+            return max(oldest + self.rtt.rto - time.time(), 0.001)
+
+    def wait(self):
+        """blocks until an ack frees up the window or the oldest chunk times out"""
+        with self.cond:
+            timeout = self.next_timeout()
+            if timeout is not None:
+                self.cond.wait(timeout)
+
+    def _mark_acked(self, index):
+        if 0 <= index < self.total_chunks and self.needed[index]:
+            self.needed[index] = 0
+            self.remaining -= 1
+            return 1
+        return 0
+
+    def _detect_reordered_loss(self, acked_seq):
+        # chunks sent well before one that was just acked are most likely lost,
+        # resend them now instead of waiting for the timer
+        lost = False
+        while self.in_flight:
+            index = next(iter(self.in_flight))
+            if self.in_flight[index][2] >= acked_seq - REORDER_THRESHOLD:
+                break
+            del self.in_flight[index]
+            self.retransmit.append(index)
+            lost = True
+        if lost:
+            self._on_loss(time.time(), timeout=False)
+
+    def _on_loss(self, now, timeout=True):
+        # halve the window (and back off the timer) at most once per rtt
+        if now - self.last_loss > (self.rtt.srtt or self.rtt.rto):
+            self.ssthresh = max(self.cwnd / 2, 2.0)
+            self.cwnd = self.ssthresh
+            self.last_loss = now
+            if timeout:
+                self.rtt.backoff()
+
+def local_max_chunk(args, binary):
+    """largest chunk this peer will send or accept, --chunk-size can lower it to the path mtu"""
+    limit = MAX_BINARY_CHUNK if binary else MAX_TEXT_CHUNK
+    if args.chunk_size:
+        limit = min(limit, args.chunk_size)
+    return max(limit // CHUNK_ALIGN * CHUNK_ALIGN, CHUNK_ALIGN)
+
+def negotiate_chunk_size(msg, args):
+    """picks (chunk_size, binary) from a FILE_OFFER's capabilities and our own"""
+    if "MAX_CHUNK_SIZE" not in msg:
+        # peer predates negotiation, stick to the original 1 KiB text chunks
+        return CHUNK_DATA_SIZE, False
+    if msg.get("GROUP_ID"):
+        # one broadcast stream serves every member, so the sender fixes the framing
+        return int(msg.get("CHUNK_SIZE")), msg.get("BINARY") == "1"
+    binary = msg.get("BINARY") == "1" and not args.no_binary
+    return max(1, min(int(msg.get("MAX_CHUNK_SIZE")), local_max_chunk(args, binary))), binary
+
+DOWNLOAD_DIR = 'downloads'
+
+def download_path(filename):
+    if not os.path.exists(DOWNLOAD_DIR):
+        os.makedirs(DOWNLOAD_DIR)
+    # never let a peer pick a path outside downloads/
+    return os.path.join(DOWNLOAD_DIR, os.path.basename(filename))
+
+def format_ranges(ranges):
+    """[(0, 10), (15, 16)] -> '0-9,15-15' (inclusive on the wire)"""
+    return ",".join(f"{start}-{end - 1}" for start, end in ranges)
+
+def parse_ranges(text):
+    ranges = []
+    for part in text.split(','):
+        if part:
+            start, end = part.split('-')
+            ranges.append((int(start), int(end) + 1))
+    return ranges
+
+def active_partials():
+    return {info['partial'].path for info in state.incoming_files.snapshot().values()}
+
+def send_receipt(sock, args, to_id, file_id, status):
+    receipt_fields = {
+        "TYPE": "FILE_RECEIVED",
+        "FROM": args.id,
+        "TO": to_id,
+        "FILEID": file_id,
+        "STATUS": status,
+        "TIMESTAMP": str(int(time.time()))
+    }
+    send_message(sock, build_message(receipt_fields), directory.address(to_id), args.verbose)
+
+def mark_completed(file_id, from_id, group_id=None):
+    # group downloads are kept apart, they're only answered on FILE_END
+    table = state.completed_group_files if group_id else state.completed_files
+    table[file_id] = from_id
+    retention.expire(table, file_id, retention.COMPLETED_TTL, 'finished file ids')
+
+def close_stalled(file_id, file_info):
+    """closes a download no chunk has reached for STALLED_DOWNLOAD seconds.
+
+    its progress is saved, so the sender offering the file again resumes it
+    """
+    with state.incoming_files.lock(file_id):
+        if state.incoming_files.get(file_id) is not file_info:
+            return  # finished, or closed already
+        idle = time.time() - file_info['active_at']
+        if idle < retention.STALLED_DOWNLOAD:
+            retention.wheel.schedule(retention.STALLED_DOWNLOAD - idle, close_stalled, file_id, file_info)
+            return
+        del state.incoming_files[file_id]
+    bitmap = file_info['bitmap']
+    if file_info['progress']['filehash']:
+        save_progress(file_info['partial'].path, file_info['progress'], bitmap)
+    file_info['partial'].close()
+    retention.count('stalled downloads')
+    print(f"\n[WARN] No chunks of '{file_info['metadata']['FILENAME']}' for {retention.STALLED_DOWNLOAD}s, "
+          f"closed at {bitmap.count}/{bitmap.total_chunks} chunks. It resumes if offered again.")
+    print(f"> ", end="", flush=True)
 
 def assemble_and_save_file(file_id, sock, args):
-    if file_id not in state.incoming_files:
+    with state.incoming_files.lock(file_id):
+        file_info = state.incoming_files.pop(file_id, None)
+    if file_info is None:
         return
 
-    file_info = state.incoming_files[file_id]
     metadata = file_info['metadata']
     filename = metadata['FILENAME']
-
-    download_dir = 'downloads'
-    if not os.path.exists(download_dir):
-        os.makedirs(download_dir)
-
-    filepath = os.path.join(download_dir, filename)
+    filepath = download_path(filename)
 
     try: 
-        with open(filepath, 'wb') as f:
-            sorted_chunks = sorted(file_info['received_chunks'].items())
-            for _, chunk_data in sorted_chunks:
-                f.write(chunk_data)
+        tree = file_info.get('tree')
+        if tree is not None and tree.root() != metadata.get("TREEHASH"):
+            # every chunk passed its crc but the whole doesn't match the offer
+            file_info['partial'].close()
+            os.remove(file_info['partial'].path)
+            remove_progress(file_info['partial'].path)
+            print(f"\n[ERROR] '{filename}' failed verification against the sender's digest and was discarded.")
+            send_receipt(sock, args, metadata['FROM'], file_id, "CORRUPT")
+            return
 
-        print(f"\nFile transfer of '{filename}' is complete. Saved to {filepath}")
+        # chunks are already in place, only the rename is left
+        file_info['partial'].finish(filepath)
+        remove_progress(file_info['partial'].path)
+        if metadata.get("FILEHASH"):
+            record_content(DOWNLOAD_DIR, metadata["FILEHASH"], filepath)
 
-        receipt_fields = {
-            "TYPE": "FILE_RECEIVED",
-            "FROM": args.id,
-            "TO": metadata['TO'],
-            "FILEID": file_id,
-            "STATUS": "COMPLETE",
-            "TIMESTAMP": str(int(time.time()))
-        }
-        ip = metadata['FROM'].split('@')[1]
-        send_message(sock, build_message(receipt_fields), ip, args.verbose)
+        verified = " (verified)" if tree is not None else ""
+        print(f"\nFile transfer of '{filename}' is complete{verified}. Saved to {filepath}")
+        send_receipt(sock, args, metadata['FROM'], file_id, "COMPLETE")
 
     except Exception as e:
         print(f"\n[ERROR] Could not save file {filename}: {e}")
     finally:
-        del state.incoming_files[file_id]
+        file_info['partial'].close()
         print(f"> ", end="", flush=True)
 
-def initiate_file_offer(sock, from_id, to_id, filepath, verbose):
+def initiate_file_offer(sock, from_id, to_id, filepath, verbose, max_chunk=MAX_BINARY_CHUNK, binary=True, job=None):
     if not os.path.exists(filepath):
         print(f"[ERROR] File not found: {filepath}")
-        return
+        return False
 
     filename = os.path.basename(filepath)
     filesize = os.path.getsize(filepath)
@@ -61,6 +320,7 @@ def initiate_file_offer(sock, from_id, to_id, filepath, verbose):
     if filetype is None:
         filetype = 'application/octet-stream'
     file_id = uuid.uuid4().hex[:8]
+    filehash, treehash = file_digests(filepath)
 
     offer_fields = {
         "TYPE": "FILE_OFFER",
@@ -70,135 +330,453 @@ def initiate_file_offer(sock, from_id, to_id, filepath, verbose):
         "FILESIZE": filesize,
         "FILETYPE": filetype,
         "FILEID": file_id,
+        "FILEHASH": filehash,
+        "TREEHASH": treehash,
         "DESCRIPTION": "Oh look a file",
+        "MAX_CHUNK_SIZE": max_chunk,
+        "BINARY": "1" if binary else "0",
         "TIMESTAMP": str(int(time.time())),
         "TOKEN": f"{from_id}|{int(time.time()) + 3600}|file"
     }
-    ip = to_id.split('@')[1]
-    send_message(sock, build_message(offer_fields), ip, verbose)
-    print(f"Sent file offer for '{filename}' to {to_id}")
-
-    # Store for sending later
+    # Store for sending later, before the offer goes out so a quick accept finds it
     state.outgoing_files[file_id] = {
         'filepath': filepath,
-        'to_id': to_id
+        'to_id': to_id,
+        'filehash': filehash
     }
+    retention.expire(state.outgoing_files, file_id, retention.OFFER_TTL, 'offers sent')
+
+    addr = directory.address(to_id)
+    send_message(sock, build_message(offer_fields), addr, verbose)
+    print(f"Sent file offer for '{filename}' to {to_id}")
+
+class ChunkSource:
+    """reads the chunks of an outgoing file and sends them.
+
+    binary chunks are memoryview slices of an mmap of the file, gathered with
+    their frame header straight into the socket; text chunks are base64
+    encoded once and kept in the chunk cache for repeated sends, and their
+    headers come from a template made once per transfer. text chunks go out
+    in bursts of up to batchio.MAX_BATCH datagrams per syscall
+    """
+    def __init__(self, filepath, filehash, chunk_size, binary):
+        self.filehash = filehash
+        self.chunk_size = chunk_size
+        self.binary = binary
+        self.f = open(filepath, 'rb')
+        self.filesize = os.fstat(self.f.fileno()).st_size
+        self.mm = None
+        self.view = None
+        self.templates = {}
+        if binary and self.filesize:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.mm.close()
+        self.f.close()
+
+    def send_chunks(self, sock, dest, file_id, from_id, to_id, chunk_indices, total_chunks, verbose, job=None):
+        """sends one burst of chunks, rate limited as a whole"""
+        frames = self.encode_burst(dest, file_id, from_id, to_id, chunk_indices, total_chunks)
+        scheduler.throttle(job, sum(len(header) + len(payload) for header, payload, _ in frames))
+        self.send_burst(sock, frames, verbose)
+
+    async def send_chunks_async(self, sock, dest, file_id, from_id, to_id, chunk_indices, total_chunks, verbose, job=None):
+        """send_chunks that waits out the rate limit without blocking the loop"""
+        frames = self.encode_burst(dest, file_id, from_id, to_id, chunk_indices, total_chunks)
+        # always yield here so one transfer can't starve the others
+        await asyncio.sleep(scheduler.throttle_delay(job, sum(len(header) + len(payload) for header, payload, _ in frames)))
+        self.send_burst(sock, frames, verbose)
+
+    def send_burst(self, sock, frames, verbose):
+        if not self.binary:
+            send_frames(sock, frames, verbose)
+            return
+        # handing sendmmsg the address of an mmap slice costs more than the
+        # syscall it saves, so binary chunks stay one zero-copy sendmsg each
+        for header, payload, dest in frames:
+            send_frame(sock, header, payload, dest, verbose)
+
+    def encode_burst(self, dest, file_id, from_id, to_id, chunk_indices, total_chunks):
+        return [self.encode_chunk(file_id, from_id, to_id, chunk_index, total_chunks) + (dest,)
+                for chunk_index in chunk_indices]
 
-def send_file_chunks(file_id, sock, from_id, to_id, filepath, verbose):
+    def encode_chunk(self, file_id, from_id, to_id, chunk_index, total_chunks):
+        """(header, payload) of a chunk: a frame header and an mmap slice, or
+        the head of a FILE_CHUNK message and its encoded DATA line"""
+        offset = chunk_index * self.chunk_size
+        if self.binary:
+            payload = self.view[offset:offset + self.chunk_size]
+            return chunk_frame_header(file_id, chunk_index, total_chunks, crc32(payload)), payload
+
+        entry = chunk_cache.get((self.filehash, self.chunk_size, chunk_index)) if self.filehash else None
+        if entry is None:
+            self.f.seek(offset)
+            data = self.f.read(self.chunk_size)
+            entry = (b'DATA: ' + base64.b64encode(data) + b'\n\n', crc32(data), len(data))
+            if self.filehash:
+                chunk_cache.put((self.filehash, self.chunk_size, chunk_index), entry, len(entry[0]))
+        payload, crc, length = entry
+        key = (file_id, from_id, to_id, total_chunks)
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = MessageTemplate({
+                "TYPE": "FILE_CHUNK",
+                "FROM": from_id,
+                "TO": to_id,
+                "FILEID": file_id,
+                "TOTAL_CHUNKS": total_chunks,
+                "TOKEN": f"{from_id}|{int(time.time()) + 3600}|file"
+            }, ("CHUNK_INDEX", "CHUNK_SIZE", "CRC32"))
+        return template.render_head(chunk_index, length, crc), payload
+
+def send_file_chunks(file_id, sock, from_id, to_id, filepath, verbose, chunk_size=CHUNK_DATA_SIZE, binary=False, ranges=None, filehash=None, job=None):
+    window = None
     try:
         filesize = os.path.getsize(filepath)
-        total_chunks = (filesize + CHUNK_DATA_SIZE - 1) // CHUNK_DATA_SIZE
-        chunk_index = 0
-        ip = to_id.split('@')[1]
-
-        with open(filepath, 'rb') as f:
-            while True:
-                chunk_data = f.read(CHUNK_DATA_SIZE)
-                if not chunk_data:
-                    break
-                chunk_fields = {
-                    "TYPE": "FILE_CHUNK",
-                    "FROM": from_id,
-                    "TO": to_id,
-                    "FILEID": file_id,
-                    "CHUNK_INDEX": chunk_index,
-                    "TOTAL_CHUNKS": total_chunks,
-                    "CHUNK_SIZE": len(chunk_data),
-                    "TOKEN": f"{from_id}|{int(time.time()) + 3600}|file",
-                    "DATA": base64.b64encode(chunk_data).decode('utf-8')
-                }
-                send_message(sock, build_message(chunk_fields), ip, verbose)
-                chunk_index += 1
-                time.sleep(0.01)
+        total_chunks = (filesize + chunk_size - 1) // chunk_size
+        addr = directory.address(to_id)
+        window = SendWindow(total_chunks, ranges)
+        state.active_sends[file_id] = window
+
+        with ChunkSource(filepath, filehash, chunk_size, binary) as source:
+            while not window.done and not window.failed:
+                for burst in batchio.batches(window.poll()):
+                    source.send_chunks(sock, addr, file_id, from_id, to_id, burst, total_chunks, verbose, job)
+                    for chunk_index in burst:
+                        window.stamp(chunk_index)
+                window.wait()
+
+        return _report_send(window, filepath, to_id, total_chunks, ranges)
+
+    except Exception as e:
+        print(f"[ERROR] Failed to send chunks for file '{filepath}': {e}")
+        return False
+    finally:
+        if window is not None:
+            with state.active_sends.lock(file_id):
+                if state.active_sends.get(file_id) is window:
+                    del state.active_sends[file_id]
+
+async def send_file_chunks_async(file_id, sock, from_id, to_id, filepath, verbose, chunk_size=CHUNK_DATA_SIZE, binary=False, ranges=None, filehash=None, job=None):
+    """send_file_chunks for the asyncio runtime, waits for acks and timeouts without a thread"""
+    loop = asyncio.get_running_loop()
+    acked = asyncio.Event()
+    window = None
+    try:
+        filesize = os.path.getsize(filepath)
+        total_chunks = (filesize + chunk_size - 1) // chunk_size
+        addr = directory.address(to_id)
+        window = SendWindow(total_chunks, ranges)
+        window.waker = lambda: loop.call_soon_threadsafe(acked.set)
+        state.active_sends[file_id] = window
 
-        print(f"Finished sending {total_chunks} chunks for file '{filepath}'")
+        with ChunkSource(filepath, filehash, chunk_size, binary) as source:
+            while not window.done and not window.failed:
+                acked.clear()
+                for burst in batchio.batches(window.poll()):
+                    await source.send_chunks_async(sock, addr, file_id, from_id, to_id, burst, total_chunks, verbose, job)
+                    for chunk_index in burst:
+                        window.stamp(chunk_index)
+                timeout = window.next_timeout()
+                if timeout is not None:
+                    try:
+                        await asyncio.wait_for(acked.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+
+        return _report_send(window, filepath, to_id, total_chunks, ranges)
 
     except Exception as e:
         print(f"[ERROR] Failed to send chunks for file '{filepath}': {e}")
+        return False
+    finally:
+        if window is not None:
+            with state.active_sends.lock(file_id):
+                if state.active_sends.get(file_id) is window:
+                    del state.active_sends[file_id]
 
-def handle_file_accepted(msg, sock, args):
+def _report_send(window, filepath, to_id, total_chunks, ranges):
+    if window.failed:
+        print(f"[ERROR] Gave up on file '{filepath}': {to_id} stopped acknowledging chunks")
+        return False
+    sent = total_chunks if ranges is None else sum(end - start for start, end in ranges)
+    print(f"Finished sending {sent} chunks for file '{filepath}'")
+    return True
+
+def handle_file_accepted(msg, sock, args, ranges=None):
     file_id = msg.get("FILEID")
     from_id = args.id
     to_id = msg.get("FROM")
 
-    if file_id in state.outgoing_files:
-        file_info = state.outgoing_files.pop(file_id)
+    file_info = state.outgoing_files.pop(file_id, None)
+    if file_info is not None:
         filepath = file_info['filepath']
-        threading.Thread(
-            target=send_file_chunks,
-            args=(file_id, sock, from_id, to_id, filepath, args.verbose),
-            daemon=True
-        ).start()
+        binary = msg.get("BINARY") == "1" and not args.no_binary
+        chunk_size = int(msg.get("CHUNK_SIZE", CHUNK_DATA_SIZE))
+        if ranges is None:
+            chunk_size = max(1, min(chunk_size, local_max_chunk(args, binary)))
+        elif chunk_size > local_max_chunk(args, binary):
+            # a resume has to keep the chunk size the receiver's bitmap was built with
+            print(f"[WARN] Cannot resume {file_id}: chunk size {chunk_size} is too large to send")
+            return
+        scheduler.submit('send', to_id, os.path.basename(filepath), send_file_chunks,
+                         (file_id, sock, from_id, to_id, filepath, args.verbose, chunk_size, binary, ranges,
+                          file_info.get('filehash')),
+                         os.path.getsize(filepath))
     else:
-        print(f"[WARN] Received FILE_ACCEPTED for unknown file ID: {file_id}")
+        print(f"[WARN] Received {msg.get('TYPE')} for unknown file ID: {file_id}")
+
+def handle_file_resume(msg, sock, args):
+    # like FILE_ACCEPTED, but only the listed chunk ranges are still missing
+    handle_file_accepted(msg, sock, args, parse_ranges(msg.get("MISSING", "")))
 
-def handle_file_offer(msg):
+@register("FILE_OFFER")
+def handle_file_offer(msg, sock, args):
     file_id = msg.get("FILEID")
     from_id = msg.get("FROM")
     filename = msg.get("FILENAME")
     filesize = msg.get("FILESIZE")
 
+    display = directory.display_name(from_id)
+    existing = lookup_content(DOWNLOAD_DIR, msg.get("FILEHASH"), int(filesize or 0))
+    if existing:
+        # same content already downloaded, tell the sender to skip it
+        receipt_fields = {
+            "TYPE": "FILE_RECEIVED",
+            "FROM": args.id,
+            "TO": from_id,
+            "FILEID": file_id,
+            "STATUS": "ALREADY_HAVE",
+            "TIMESTAMP": str(int(time.time()))
+        }
+        send_message(sock, build_message(receipt_fields), directory.address(from_id), args.verbose)
+        print(f"\nUser {display} offered '{filename}', which you already have at {existing}. Skipped.")
+        print(f"> ", end="", flush=True)
+        return
+
     state.file_offers[file_id] = msg
-    display = state.peers.get(from_id, (from_id))[0]
+    retention.expire(state.file_offers, file_id, retention.token_ttl(msg, retention.OFFER_TTL), 'offers received')
 
     print(f"\nUser {display} is sending you a file: '{filename}' ({filesize} bytes).")
+    progress = find_progress(DOWNLOAD_DIR, msg.get("FILEHASH"), int(filesize or 0), active_partials())
+    if progress:
+        _, _, bitmap = progress
+        print(f"A partial download of this file is {bitmap.count * 100 // max(bitmap.total_chunks, 1)}% done, accepting will resume it.")
     print(f"To accept, type: accept {file_id}")
     print(f"> ", end="", flush=True)
 
+@functools.lru_cache(maxsize=256)
+def ack_template(from_id, to_id, file_id):
+    return MessageTemplate({
+        "TYPE": "FILE_ACK",
+        "FROM": from_id,
+        "TO": to_id,
+        "FILEID": file_id
+    }, ("CHUNK_INDEX", "ACK_UPTO"))
+
+def send_file_ack(sock, args, to_id, file_id, chunk_index, ack_upto):
+    addr = directory.address(to_id)
+    send_message(sock, ack_template(args.id, to_id, file_id).render(chunk_index, ack_upto), addr, args.verbose)
+
+@register("FILE_CHUNK")
 def handle_file_chunk(msg, sock, args):
-    file_id = msg.get("FILEID")
-    if file_id in state.incoming_files:
-        file_info = state.incoming_files[file_id]
-        total_chunks = int(msg.get("TOTAL_CHUNKS"))
-        file_info['total_chunks'] = total_chunks
-        chunk_index = int(msg.get("CHUNK_INDEX"))
-        data = base64.b64decode(msg.get("DATA"))
+    crc = msg.get("CRC32")
+    store_chunk(msg.get("FILEID"), msg.get("FROM"), int(msg.get("CHUNK_INDEX")),
+                int(msg.get("TOTAL_CHUNKS")), base64.b64decode(msg.get("DATA")), sock, args,
+                int(crc) if crc else None)
+
+def handle_chunk_frame(raw, sock, args):
+    file_id, chunk_index, total_chunks, crc, data = parse_chunk_frame(raw)
+    file_info = state.incoming_files.get(file_id)
+    if file_info is not None:
+        from_id = file_info['metadata']['FROM']
+    else:
+        from_id = state.completed_files.get(file_id)
+        if from_id is None:
+            return
+    store_chunk(file_id, from_id, chunk_index, total_chunks, bytes(data), sock, args, crc)
+
+def store_chunk(file_id, from_id, chunk_index, total_chunks, data, sock, args, crc=None):
+    if file_id in state.completed_files:
+        # our last acks were lost, tell the sender everything is here
+        send_file_ack(sock, args, from_id, file_id, chunk_index, total_chunks)
+        return
+
+    # the file's lock keeps assemble_and_save_file from closing it under a write
+    with state.incoming_files.lock(file_id):
+        file_info = state.incoming_files.get(file_id)
+        if file_info is None:
+            return
+        bitmap = file_info['bitmap']
+        if total_chunks != bitmap.total_chunks:
+            return
+        group_id = file_info['metadata'].get("GROUP_ID")
+
+        if crc is not None and crc32(data) != crc:
+            metrics.event('damaged chunks')
+            # damaged in transit, ask for it again right away (group members wait for FILE_END)
+            if not group_id:
+                nack_fields = {
+                    "TYPE": "FILE_NACK",
+                    "FROM": args.id,
+                    "TO": from_id,
+                    "FILEID": file_id,
+                    "MISSING": format_ranges([(chunk_index, chunk_index + 1)])
+                }
+                send_message(sock, build_message(nack_fields), directory.address(from_id), args.verbose)
+            return
 
-        if chunk_index not in file_info['received_chunks']:
-            file_info['received_chunks'][chunk_index] = data
+        # written straight to its offset, nothing is kept in memory
+        if chunk_index not in bitmap:
+            file_info['partial'].write_chunk(chunk_index, data)
+            bitmap.add(chunk_index)
+            file_info['received'] += len(data)
+            if file_info['tree'] is not None:
+                file_info['tree'].add_chunk(chunk_index, file_info['chunk_size'], data)
+            now = file_info['active_at'] = time.time()
+            if now - file_info['saved_at'] > PROGRESS_SAVE_INTERVAL:
+                save_progress(file_info['partial'].path, file_info['progress'], bitmap)
+                file_info['saved_at'] = now
 
-        if len(file_info['received_chunks']) == total_chunks:
+        if not group_id:
+            # count of chunks received without gaps from the start
+            file_info['ack_upto'] = bitmap.first_missing(file_info['ack_upto'])
+            send_file_ack(sock, args, from_id, file_id, chunk_index, file_info['ack_upto'])
+
+        if bitmap.complete:
+            mark_completed(file_id, from_id, group_id)
             assemble_and_save_file(file_id, sock, args)
 
-def handle_file_received(msg):
+@register("FILE_ACK")
+def handle_file_ack(msg, sock, args):
+    window = state.active_sends.get(msg.get("FILEID"))
+    if window is not None:
+        window.on_ack(int(msg.get("CHUNK_INDEX")), int(msg.get("ACK_UPTO", 0)))
+
+def handle_file_nack(msg, sock, args):
+    # the receiver got these chunks damaged
+    window = state.active_sends.get(msg.get("FILEID"))
+    if window is not None:
+        window.on_nack(parse_ranges(msg.get("MISSING", "")))
+
+def handle_file_received(msg, sock, args):
     from_id = msg.get("FROM")
     status = msg.get("STATUS")
     file_id = msg.get("FILEID")
-    display = state.peers.get(from_id, (from_id))[0]
+    window = state.active_sends.get(file_id)
+    if window is not None:
+        window.finish()
+    display = directory.display_name(from_id)
+    if status == "CORRUPT":
+        print(f"\n[ERROR] User {display} could not verify file {file_id}, it was discarded.")
+        print(f"> ", end="", flush=True)
+        return
+    if status == "ALREADY_HAVE":
+        offer = state.outgoing_files.pop(file_id, None)
+        if offer:
+            print(f"\nUser {display} already has '{os.path.basename(offer['filepath'])}', nothing to send.")
+            print(f"> ", end="", flush=True)
+        return
     utils.log(f"User {display} confirmed file received: {file_id}", "INFO")
 
 def process_sendfile(cmd, sock, args):
     try:
         _, to_id, filepath = cmd.split(' ', 2)
-        threading.Thread(
-            target=initiate_file_offer,
-            args=(sock, args.id, to_id, filepath, args.verbose),
-            daemon=True
-        ).start()
+        scheduler.submit('offer', to_id, os.path.basename(filepath), initiate_file_offer,
+                         (sock, args.id, to_id, filepath, args.verbose,
+                          local_max_chunk(args, not args.no_binary), not args.no_binary))
     except ValueError:
         print("Usage: sendfile <user_id> <path_to_file>")
 
 def process_accept(cmd, sock, args):
     try:
         _, file_id_to_accept = cmd.split(' ', 1)
-        if file_id_to_accept in state.file_offers:
-            offer = state.file_offers.pop(file_id_to_accept)
+        offer = state.file_offers.pop(file_id_to_accept, None)
+        if offer is not None:
+            chunk_size, binary = negotiate_chunk_size(offer, args)
+            filesize = int(offer['FILESIZE'])
+            msg_type = "FILE_ACCEPTED"
+
+            progress = find_progress(DOWNLOAD_DIR, offer.get("FILEHASH"), filesize, active_partials())
+            if progress and offer.get("GROUP_ID") and progress[1]['chunk_size'] != chunk_size:
+                # a group is broadcast in the sender's chunk size, a .part in another one can't take it
+                progress = None
+            if progress:
+                # pick up where the earlier download stopped, in its chunk size
+                partial_path, record, bitmap = progress
+                chunk_size = record['chunk_size']
+                msg_type = "FILE_RESUME"
+            else:
+                partial_path = download_path(offer['FILENAME']) + f'.{file_id_to_accept}.part'
+                bitmap = ChunkBitmap((filesize + chunk_size - 1) // chunk_size)
+
+            partial = PartialFile(partial_path, filesize, chunk_size)
+
+            # the digest is folded in as chunks land, so there is no re-read at the end
+            tree = None
+            if offer.get("TREEHASH") and chunk_size % LEAF_SIZE == 0:
+                tree = TreeHasher(num_leaves(filesize))
+                # only the part saved before a restart has to be read back
+                for start, end in bitmap.present_ranges():
+                    for index in range(start, end):
+                        tree.add_chunk(index, chunk_size, partial.read_chunk(index))
+
+            progress_info = {
+                'file_id': file_id_to_accept,
+                'filename': offer['FILENAME'],
+                'filesize': filesize,
+                'filehash': offer.get("FILEHASH"),
+                'chunk_size': chunk_size
+            }
             state.incoming_files[file_id_to_accept] = {
                 'metadata': offer,
-                'received_chunks': {},
-                'total_chunks': 0
+                'partial': partial,
+                'bitmap': bitmap,
+                'ack_upto': bitmap.first_missing(),
+                'chunk_size': chunk_size,
+                'tree': tree,
+                'progress': progress_info,
+                'saved_at': time.time(),
+                'active_at': time.time(),
+                'accepted_at': time.time(),
+                'received': 0  # bytes written since accepting, for the download rate
             }
-            print(f"Accepted file transfer for '{offer['FILENAME']}'. Waiting for chunks...")
+            retention.wheel.schedule(retention.STALLED_DOWNLOAD, close_stalled,
+                                     file_id_to_accept, state.incoming_files[file_id_to_accept])
+            if offer.get("FILEHASH"):
+                save_progress(partial_path, progress_info, bitmap)
 
             accept_fields = {
-                "TYPE": "FILE_ACCEPTED",
+                "TYPE": msg_type,
                 "FROM": args.id,
                 "TO": offer['FROM'],
                 "FILEID": file_id_to_accept,
+                "CHUNK_SIZE": chunk_size,
+                "BINARY": "1" if binary else "0",
                 "TIMESTAMP": str(int(time.time()))
             }
-            ip = offer['FROM'].split('@')[1]
-            send_message(sock, build_message(accept_fields), ip, args.verbose)
+            if progress:
+                accept_fields["MISSING"] = format_ranges(bitmap.missing_ranges())
+                print(f"Resuming file transfer for '{offer['FILENAME']}' ({bitmap.count}/{bitmap.total_chunks} chunks already here)...")
+            else:
+                print(f"Accepted file transfer for '{offer['FILENAME']}'. Waiting for chunks...")
+            addr = directory.address(offer['FROM'])
+            send_message(sock, build_message(accept_fields), addr, args.verbose)
+
+            if bitmap.complete:
+                # empty file, or every chunk was already saved before a restart
+                mark_completed(file_id_to_accept, offer['FROM'], offer.get("GROUP_ID"))
+                assemble_and_save_file(file_id_to_accept, sock, args)
         else:
             print("Invalid or expired file offer ID.")
     except ValueError:
@@ -0,0 +1,235 @@
+import os
+import itertools
+import mimetypes
+import uuid
+import time
+import threading
+import state
+import directory
+import scheduler
+import batchio
+import file_transfer
+from network import send_message
+from parser import build_message
+from registry import register
+from storage import file_digests
+from file_transfer import ChunkSource, format_ranges, parse_ranges, local_max_chunk
+
+JOIN_TIMEOUT = 60                   # seconds members get to accept the offer
+REPAIR_WAIT = 0.5                   # seconds spent collecting NACKs per repair round
+MAX_IDLE_ROUNDS = 10                # repair rounds nobody answered before giving up
+MAX_STALLED_ROUNDS = 10             # rounds a member may NACK the same gaps before it is given up on
+GROUP_SEND_RATE = 8 * 1024 * 1024   # pace of the broadcast stream when no rate is configured
+MAX_NACK_RANGES = 200               # keeps a FILE_NACK inside one datagram
+
+# --- sending a file to a group
+
+def process_sendfile_group(cmd, sock, args):
+    # processes "sendfile-group" cmd
+    try:
+        _, group_id, filepath = cmd.split(' ', 2)
+    except ValueError:
+        print("Usage: sendfile-group <group_id> <path_to_file>")
+        return
+
+    if group_id not in state.groups or args.id not in state.groups[group_id]['members']:
+        print("Error: You are not a member of that group or the group does not exist.")
+        return
+    if not os.path.exists(filepath):
+        print(f"[ERROR] File not found: {filepath}")
+        return
+
+    scheduler.submit('group', group_id, os.path.basename(filepath), distribute_file,
+                     (sock, args, group_id, filepath), os.path.getsize(filepath))
+
+def distribute_file(sock, args, group_id, filepath, job=None):
+    """offers a file to every group member, then broadcasts each chunk once and repairs gaps from NACKs"""
+    binary = not args.no_binary
+    chunk_size = local_max_chunk(args, binary)
+    filename = os.path.basename(filepath)
+    filesize = os.path.getsize(filepath)
+    total_chunks = (filesize + chunk_size - 1) // chunk_size
+    filetype, _ = mimetypes.guess_type(filepath)
+    file_id = uuid.uuid4().hex[:8]
+    filehash, treehash = file_digests(filepath)
+    members = state.groups[group_id]['members'] - {args.id}
+
+    send = {
+        'group_id': group_id,
+        'joined': set(),    # members that accepted or resumed
+        'done': set(),      # members with the whole file
+        'replied': set(),   # members that answered the current FILE_END
+        'missing': set(),   # chunk indices to repair in the next round
+        'nacks': {},        # member -> MISSING of its FILE_NACK in the current round
+        'full': False,      # someone accepted from scratch, so every chunk has to go out
+        'cond': threading.Condition()
+    }
+    state.group_sends[file_id] = send
+    cond = send['cond']
+
+    try:
+        offer_fields = {
+            "TYPE": "FILE_OFFER",
+            "FROM": args.id,
+            "GROUP_ID": group_id,
+            "FILENAME": filename,
+            "FILESIZE": filesize,
+            "FILETYPE": filetype or 'application/octet-stream',
+            "FILEID": file_id,
+            "FILEHASH": filehash,
+            "TREEHASH": treehash,
+            "DESCRIPTION": f"Sent to group {group_id}",
+            "MAX_CHUNK_SIZE": chunk_size,
+            "CHUNK_SIZE": chunk_size,
+            "BINARY": "1" if binary else "0",
+            "TIMESTAMP": str(int(time.time())),
+            "TOKEN": f"{args.id}|{int(time.time()) + 3600}|file"
+        }
+        message = build_message(offer_fields)
+        for member_id in members:
+            send_message(sock, message, directory.address(member_id), args.verbose)
+        print(f"Sent file offer for '{filename}' to group {group_id} ({len(members)} members)")
+
+        with cond:
+            cond.wait_for(lambda: send['joined'] | send['done'] >= members, timeout=JOIN_TIMEOUT)
+            if not send['joined'] - send['done']:
+                print(f"Nobody in group {group_id} needs '{filename}', nothing to send.")
+                return True
+            to_send = range(total_chunks) if send['full'] else sorted(send['missing'])
+            send['missing'] = set()
+
+        if not job.bucket.rate:
+            job.bucket.rate = GROUP_SEND_RATE
+
+        idle_rounds = 0
+        last_nacks = {}  # member -> MISSING it reported the round before
+        stalled = {}     # member -> rounds in a row it reported the same gaps
+        given_up = set()
+        with ChunkSource(filepath, filehash, chunk_size, binary) as source:
+            for round_no in itertools.count(1):
+                for burst in batchio.batches(to_send):
+                    source.send_chunks(sock, "<broadcast>", file_id, args.id, group_id,
+                                       burst, total_chunks, args.verbose, job)
+
+                with cond:
+                    pending = send['joined'] - send['done'] - given_up
+                    if not pending:
+                        break
+                    send['replied'] = set()
+                    send['nacks'] = {}
+
+                # ask everyone still missing something for their gaps, in one batch
+                end_fields = {
+                    "TYPE": "FILE_END",
+                    "FROM": args.id,
+                    "GROUP_ID": group_id,
+                    "FILEID": file_id,
+                    "TOTAL_CHUNKS": total_chunks,
+                    "ROUND": round_no
+                }
+                send_message(sock, build_message(end_fields), "<broadcast>", args.verbose)
+
+                with cond:
+                    cond.wait_for(lambda: pending <= send['replied'] | send['done'], timeout=REPAIR_WAIT)
+                    to_send = sorted(send['missing'])
+                    send['missing'] = set()
+                    idle_rounds = 0 if send['replied'] or send['done'] & pending else idle_rounds + 1
+                    nacks = dict(send['nacks'])
+                if idle_rounds >= MAX_IDLE_ROUNDS:
+                    print(f"[ERROR] Gave up on '{filename}' for {', '.join(sorted(pending))}: no response")
+                    return False
+
+                # a member whose gaps never shrink (it can't store what we send) would keep the repair going forever
+                for member, missing in nacks.items():
+                    stalled[member] = stalled.get(member, 0) + 1 if last_nacks.get(member) == missing else 0
+                    last_nacks[member] = missing
+                stuck = {member for member in pending if stalled.get(member, 0) >= MAX_STALLED_ROUNDS}
+                if stuck:
+                    print(f"[ERROR] Gave up on '{filename}' for {', '.join(sorted(stuck))}: no progress in {MAX_STALLED_ROUNDS} rounds")
+                    given_up |= stuck
+
+        print(f"Finished sending '{filename}' to group {group_id} ({len(send['done'])} members received it)")
+        return not given_up
+    finally:
+        state.group_sends.pop(file_id, None)
+
+def handle_group_join(msg):
+    # a member accepted (FILE_ACCEPTED) or resumed (FILE_RESUME) a group offer
+    send = state.group_sends.get(msg.get("FILEID"))
+    if send is None:
+        return
+    with send['cond']:
+        send['joined'].add(msg.get("FROM"))
+        if msg.get("TYPE") == "FILE_RESUME":
+            for start, end in parse_ranges(msg.get("MISSING", "")):
+                send['missing'].update(range(start, end))
+        else:
+            send['full'] = True
+        send['cond'].notify_all()
+
+def handle_group_received(msg):
+    # a member has the whole file, either just now or from an earlier download
+    send = state.group_sends.get(msg.get("FILEID"))
+    if send is None:
+        return
+    with send['cond']:
+        send['done'].add(msg.get("FROM"))
+        send['cond'].notify_all()
+
+def handle_file_nack(msg):
+    send = state.group_sends.get(msg.get("FILEID"))
+    if send is None:
+        return
+    with send['cond']:
+        for start, end in parse_ranges(msg.get("MISSING", "")):
+            send['missing'].update(range(start, end))
+        send['replied'].add(msg.get("FROM"))
+        send['nacks'][msg.get("FROM")] = msg.get("MISSING", "")
+        send['cond'].notify_all()
+
+def _group_or_unicast(group_handler, unicast_handler):
+    # replies to a group offer share their TYPE with the unicast ones, tell them apart by FILEID
+    def handler(msg, sock, args):
+        if msg.get("FILEID") in state.group_sends:
+            group_handler(msg)
+        else:
+            unicast_handler(msg, sock, args)
+    return handler
+
+register("FILE_ACCEPTED")(_group_or_unicast(handle_group_join, file_transfer.handle_file_accepted))
+register("FILE_RESUME")(_group_or_unicast(handle_group_join, file_transfer.handle_file_resume))
+register("FILE_RECEIVED")(_group_or_unicast(handle_group_received, file_transfer.handle_file_received))
+register("FILE_NACK")(_group_or_unicast(handle_file_nack, file_transfer.handle_file_nack))
+
+# --- receiving a group file
+
+@register("FILE_END")
+def handle_file_end(msg, sock, args):
+    # the sender finished a pass, report which chunks we still lack
+    file_id = msg.get("FILEID")
+    from_id = msg.get("FROM")
+    addr = directory.address(from_id)
+
+    with state.incoming_files.lock(file_id):
+        file_info = state.incoming_files.get(file_id)
+        missing = file_info['bitmap'].missing_ranges() if file_info is not None else None
+    if missing is not None:
+        nack_fields = {
+            "TYPE": "FILE_NACK",
+            "FROM": args.id,
+            "TO": from_id,
+            "FILEID": file_id,
+            "MISSING": format_ranges(missing[:MAX_NACK_RANGES])
+        }
+        send_message(sock, build_message(nack_fields), addr, args.verbose)
+    elif file_id in state.completed_group_files:
+        # our FILE_RECEIVED was lost
+        receipt_fields = {
+            "TYPE": "FILE_RECEIVED",
+            "FROM": args.id,
+            "TO": from_id,
+            "FILEID": file_id,
+            "STATUS": "COMPLETE",
+            "TIMESTAMP": str(int(time.time()))
+        }
+        send_message(sock, build_message(receipt_fields), addr, args.verbose)
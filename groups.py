@@ -1,7 +1,23 @@
+import functools
 import time
 import state
-from network import send_message
-from parser import build_message
+import directory
+from network import reliable, new_message_id, EXACTLY_ONCE
+from parser import build_message, MessageTemplate
+from registry import register
+
+BROADCAST_MIN_RECIPIENTS = 8  # from this many on, one broadcast costs less than a unicast each
+
+def send_to_group(sock, message, member_ids, args, message_id):
+    """sends message to the other member_ids: a unicast each for a small group,
+    or one broadcast the other peers ignore by GROUP_ID for a large one.
+    the members ack message_id and whoever doesn't gets it again by unicast,
+    so one on another port or behind NAT still gets it. members the peer
+    directory has seen leave are skipped"""
+    addrs = [directory.address(member_id) for member_id in member_ids
+             if member_id != args.id and not directory.is_gone(member_id)]
+    broadcast = len(addrs) >= BROADCAST_MIN_RECIPIENTS
+    reliable.send_many(sock, message, addrs, message_id, args.verbose, broadcast)
 
 # --- handling group cmds ---
 def process_creategroup(cmd, sock, args):
@@ -29,14 +45,13 @@ def process_creategroup(cmd, sock, args):
             "GROUP_NAME": group_name, 
             "MEMBERS": ",".join(initial_members),
             "TIMESTAMP": str(int(time.time())), 
-            "TOKEN": f"{args.id}|9999999999|group"
+            "TOKEN": f"{args.id}|9999999999|group",
+            "MESSAGE_ID": new_message_id()
         }
         msg = build_message(fields)
 
-        # send GROUP_CREATE msg to all members part of the group
-        for member_id in initial_members:
-            ip = member_id.split('@')[1]
-            send_message(sock, msg, ip, args.verbose)
+        # send GROUP_CREATE msg to all members part of the group, each of them acks it
+        send_to_group(sock, msg, initial_members, args, fields["MESSAGE_ID"])
 
         # print group creation success
         print(f"Group '{group_name}' created and invites sent.")
@@ -59,7 +74,8 @@ def process_updategroup(cmd, sock, args):
                 "TYPE": "GROUP_UPDATE", 
                 "FROM": args.id, 
                 "GROUP_ID": group_id,
-                "TIMESTAMP": str(int(time.time())), "TOKEN": f"{args.id}|9999999999|group"
+                "TIMESTAMP": str(int(time.time())), "TOKEN": f"{args.id}|9999999999|group",
+                "MESSAGE_ID": new_message_id()
             }
 
             # set ADD / REMOVE fields
@@ -73,10 +89,8 @@ def process_updategroup(cmd, sock, args):
             current_members = state.groups[group_id]['members']
             all_recipients = current_members.union(members_to_act)
 
-            # send GROUP_UPDATE to group members and members added / removed
-            for member_id in all_recipients:
-                ip = member_id.split('@')[1]
-                send_message(sock, message, ip, args.verbose)
+            # send GROUP_UPDATE to group members and members added / removed, each of them acks it
+            send_to_group(sock, message, all_recipients, args, fields["MESSAGE_ID"])
 
             # print group update success
             print(f"Group update sent for '{state.groups[group_id]['group_name']}'.")
@@ -85,6 +99,15 @@ def process_updategroup(cmd, sock, args):
     except ValueError:
         print("Usage: addtogroup <group_id> <user1>,<user2> OR removefromgroup <group_id> <user1>")
 
+@functools.lru_cache(maxsize=64)
+def gmsg_template(from_id, group_id):
+    return MessageTemplate({
+        "TYPE": "GROUP_MESSAGE",
+        "FROM": from_id,
+        "GROUP_ID": group_id,
+        "TOKEN": f"{from_id}|9999999999|group"
+    }, ("CONTENT", "TIMESTAMP", "MESSAGE_ID"))
+
 def process_gmsg(cmd, sock, args):
     # processes "gmsg" cmd
     try:
@@ -93,21 +116,12 @@ def process_gmsg(cmd, sock, args):
 
         # check if group exists and user is part of the group
         if group_id in state.groups and args.id in state.groups[group_id]['members']:
-            # prepare GROUP_MESSAGE msg
-            fields = {
-                "TYPE": "GROUP_MESSAGE", 
-                "FROM": args.id, 
-                "GROUP_ID": group_id,
-                "CONTENT": content, 
-                "TIMESTAMP": str(int(time.time())),
-                "TOKEN": f"{args.id}|9999999999|group"
-            }
-            message = build_message(fields)
+            # prepare GROUP_MESSAGE msg, encoded once for every member
+            message_id = new_message_id()
+            message = gmsg_template(args.id, group_id).render(content, int(time.time()), message_id)
 
-            # send GROUP_MESSAGE to group members
-            for member_id in state.groups[group_id]['members']:
-                ip = member_id.split('@')[1]
-                send_message(sock, message, ip, args.verbose)
+            # send GROUP_MESSAGE to the other group members, each of them acks it
+            send_to_group(sock, message, state.groups[group_id]['members'], args, message_id)
         else:
             print("Error: You are not a member of that group or the group does not exist.")
     except ValueError:
@@ -119,7 +133,7 @@ def process_listgroups(args):
     found = False
 
     # list all group info
-    for group_id, group_data in state.groups.items():
+    for group_id, group_data in state.groups.snapshot().items():
         if args.id in group_data['members']:
             found = True
             print(f"- {group_data['group_name']} ({group_id})")
@@ -132,7 +146,24 @@ def process_listgroups(args):
     print("-----------------------")
 
 # --- handling group messages
-def handle_group_create(msg, args):
+def _names(text):
+    return set(m.strip() for m in text.split(',') if m)
+
+def is_member(msg, args):
+    # a broadcast GROUP_MESSAGE reaches everyone, only members take (and ack) it
+    group = state.groups.get(msg.get("GROUP_ID"))
+    return group is not None and args.id in group['members']
+
+def is_invited(msg, args):
+    # likewise a GROUP_CREATE, for the members it names
+    return args.id in _names(msg.get("MEMBERS", ""))
+
+def is_concerned(msg, args):
+    # and a GROUP_UPDATE, for members and whoever it adds or removes
+    return is_member(msg, args) or args.id in _names(msg.get("ADD", "")) | _names(msg.get("REMOVE", ""))
+
+@register("GROUP_CREATE", EXACTLY_ONCE, only_if=is_invited)
+def handle_group_create(msg, sock, args):
     # handles GROUP_CREATE msg
     group_id = msg.get("GROUP_ID")
     members_str = msg.get("MEMBERS", "")
@@ -152,14 +183,16 @@ def handle_group_create(msg, args):
             print(f"\nYou've been added to group '{msg.get('GROUP_NAME')}' ({group_id}).")
             print(f"> ", end="", flush=True)
 
-def handle_group_update(msg):
+@register("GROUP_UPDATE", EXACTLY_ONCE, only_if=is_concerned)
+def handle_group_update(msg, sock, args):
     # handles GROUP_UPDATE msgs
     group_id = msg.get("GROUP_ID")
 
     # if group is found (aka user is member of the group)
-    if group_id in state.groups:
-        group = state.groups[group_id]
-
+    group = state.groups.get(group_id)
+    if group is None:
+        return
+    with state.groups.lock(group_id):
         # if msg originates from the groups creator (only creator can edit groups)
         if msg.get("FROM") == group['creator']:
             # retrieve list of members to add / remove
@@ -167,20 +200,21 @@ def handle_group_update(msg):
             to_remove = set(m.strip() for m in msg.get("REMOVE", "").split(',') if m)
 
             # add / remove members depending on msg action (ADD / REMOVE)
-            group['members'].update(to_add)
-            group['members'].difference_update(to_remove)
+            # a new set, so a send iterating the old one never sees it change
+            group['members'] = (group['members'] | to_add) - to_remove
             print(f"\nThe group “{group['group_name']}” member list was updated.")
             print(f"> ", end="", flush=True)
 
-def handle_group_message(msg, args):
+@register("GROUP_MESSAGE", EXACTLY_ONCE, only_if=is_member)
+def handle_group_message(msg, sock, args):
     # handles GROUP_MESSAGE msgs
     group_id = msg.get("GROUP_ID")
     
     # if group is found and user is member of the group
-    if group_id in state.groups and args.id in state.groups[group_id]['members']:
+    if is_member(msg, args):
         # display group name, members, and msg
         from_id = msg.get("FROM")
         content = msg.get("CONTENT")
-        display = state.peers.get(from_id, (from_id,))[0]
+        display = directory.display_name(from_id)
         print(f"\n[{state.groups[group_id]['group_name']}] {display}: {content}")
         print(f"> ", end="", flush=True)
@@ -0,0 +1,63 @@
+import hashlib
+import zlib
+
+LEAF_SIZE = 1024  # tree hash leaves; negotiated chunk sizes are whole multiples of this
+
+def crc32(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+def leaf_digest(data):
+    return hashlib.sha256(b'\x00' + data).digest()
+
+def node_digest(left, right):
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+class TreeHasher:
+    """binary hash tree over LEAF_SIZE leaves that can be fed leaves in any order.
+
+    sibling pairs are folded into their parent as soon as both are known, so
+    only the frontier of a mostly in-order download is kept in memory. a level
+    with an odd count promotes its last node unchanged.
+    """
+    def __init__(self, num_leaves):
+        self.level_sizes = [max(num_leaves, 1)]
+        while self.level_sizes[-1] > 1:
+            self.level_sizes.append((self.level_sizes[-1] + 1) // 2)
+        self.nodes = {}  # (level, index) -> digest
+        self.num_leaves = num_leaves
+
+    def add_leaf(self, index, digest):
+        level = 0
+        while level < len(self.level_sizes) - 1:
+            if index % 2 == 0 and index == self.level_sizes[level] - 1:
+                # last node of an odd level moves up as is
+                index //= 2
+                level += 1
+                continue
+            sibling = self.nodes.pop((level, index ^ 1), None)
+            if sibling is None:
+                break
+            left, right = (digest, sibling) if index % 2 == 0 else (sibling, digest)
+            digest = node_digest(left, right)
+            index //= 2
+            level += 1
+        self.nodes[(level, index)] = digest
+
+    def add_chunk(self, chunk_index, chunk_size, data):
+        """adds every leaf of a chunk; chunk_size must be a multiple of LEAF_SIZE"""
+        first = chunk_index * (chunk_size // LEAF_SIZE)
+        view = memoryview(data)
+        for i in range(0, len(data), LEAF_SIZE):
+            self.add_leaf(first + i // LEAF_SIZE, leaf_digest(view[i:i + LEAF_SIZE]))
+
+    def root(self):
+        """hex root once every leaf has been added, else None"""
+        if self.num_leaves == 0:
+            return leaf_digest(b'').hex()
+        top = (len(self.level_sizes) - 1, 0)
+        if len(self.nodes) == 1 and top in self.nodes:
+            return self.nodes[top].hex()
+        return None
+
+def num_leaves(filesize):
+    return (filesize + LEAF_SIZE - 1) // LEAF_SIZE
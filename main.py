@@ -1,14 +1,28 @@
 import argparse
+import functools
+import socket
 import threading
-from network import create_socket, receive_loop, send_message
-from parser import parse_message, build_message
-import uuid
+from network import create_socket, receive_loop, send_message, ReceiveDispatcher
+from network import reliable, new_message_id, socket_queues, set_batch_send, AT_LEAST_ONCE, EXACTLY_ONCE
+from parser import parse_message, peek, build_message, MessageTemplate
 import time
 import state
 import utils
 import file_transfer
 import tictactoe
 import groups
+import group_transfer
+import scheduler
+import storage
+import aio_runtime
+import shards
+import registry
+import retention
+import directory
+import metrics
+from registry import register
+
+TIMELINE_PAGE = 20  # posts shown per timeline page
 
 print(">> Starting LSNP peer...")
 
@@ -16,300 +30,510 @@ def send_ping(sock, user_id, verbose):
     # sends a ping message every 5 mins
     while True:
         time.sleep(300)
-        utils.log("Sending periodic PING", "SEND")
-        ping_fields = {
-            "TYPE": "PING",
-            "USER_ID": user_id
-        }
-        send_message(sock, build_message(ping_fields), "<broadcast>", verbose)
+        periodic_ping(sock, user_id, verbose)
+
+@functools.lru_cache(maxsize=None)
+def ping_message(user_id):
+    return MessageTemplate({
+        "TYPE": "PING",
+        "USER_ID": user_id
+    }).render()
+
+def periodic_ping(sock, user_id, verbose):
+    utils.log("Sending periodic PING", "SEND")
+    directory.pinged()
+    send_message(sock, ping_message(user_id), "<broadcast>", verbose)
+
+def send_profile(sock, args):
+    send_message(sock, directory.profile_message(args.id, args.name), '<broadcast>', args.verbose)
+
+def start_peer(sock, args, receiver):
+    # once the socket is up: announce ourselves, open the metrics endpoint
+    send_profile(sock, args)
+    if args.metrics_port:
+        watch(sock, receiver)
+        metrics.serve(args.metrics_port, lambda: '\n'.join(stats_lines(sock, receiver)) + '\n')
+        print(f"[LSNP] Metrics at http://127.0.0.1:{args.metrics_port}/metrics and /stats")
 
 def handle_message(raw, addr, sock, args):
+    if isinstance(raw, bytes):
+        metrics.timed('FILE_CHUNK', file_transfer.handle_chunk_frame, raw, sock, args)
+        return
+
+    # do not process own broadcast msgs, most can be told from their first two lines
+    head = peek(raw)
+    if head is not None and head[1] == args.id:
+        if args.verbose:
+            utils.log(f"RECV < self [{head[0]}]", "RECV", head[0])
+        return
+
     msg = parse_message(raw)
     msg_type = msg.get("TYPE", "UNKNOWN")
 
-    # do not process own broadcast msgs
     sender_id = msg.get("USER_ID") or msg.get("FROM")
     if sender_id == args.id:
         if args.verbose:
-            utils.log(f"RECV < self [{msg_type}]", "RECV")
+            utils.log(f"RECV < self [{msg_type}]", "RECV", msg_type)
         return
 
-    utils.log(f"RECV < {addr[0]} [{msg_type}]", "RECV")
+    if args.verbose:
+        utils.log(f"RECV < {addr[0]}:{addr[1]} [{msg_type}]", "RECV", msg_type)
+    if sender_id:
+        directory.seen(sender_id, addr)
 
-    if msg_type == "PROFILE":
-        user_id = msg.get("USER_ID")
-        display = msg.get("DISPLAY_NAME", user_id)
-        status = msg.get("STATUS", "")
-        state.peers[user_id] = (display, status)
-        print(f"[PROFILE] {display} — {status}")
+    if msg_type == "ACK":
+        # acks carry no sender id, the address says which peer it was
+        reliable.acknowledged(msg.get("MESSAGE_ID"), addr)
+        return
 
-    elif msg_type == "POST":
-        user_id = msg.get("USER_ID")
-        content = msg.get("CONTENT", "")
-        timestamp = msg.get("TIMESTAMP")
-        if user_id and timestamp:
-            post_key = (user_id, timestamp)
-            if post_key not in state.posts:
-                state.posts[post_key] = {
-                    'content': content,
-                    'likes': set()
-                }
-                display = state.peers.get(user_id, (user_id,))[0]
-                print(f"[POST] {display}: {content}")
-
-    elif msg_type == "DM":
-        from_id = msg.get("FROM")
-        to_id = msg.get("TO")
-        content = msg.get("CONTENT", "")
-        state.dms.append((from_id, to_id, content))
-        display = state.peers.get(from_id, (from_id,))[0]
-        print(f"[DM] {display} to you: {content}")
-
-    elif msg_type == "FOLLOW":
-        from_id = msg.get("FROM")
-        display = state.peers.get(from_id, (from_id,))[0]
-        print(f"User {display} has followed you")
-
-    elif msg_type == "UNFOLLOW":
-        from_id = msg.get("FROM")
-        display = state.peers.get(from_id, (from_id,))[0]
-        print(f"User {display} has unfollowed you")
-
-    elif msg_type == "LIKE":
-        from_id = msg.get("FROM")
-        to_id = msg.get("TO")
-        post_timestamp = msg.get("POST_TIMESTAMP")
-        action = msg.get("ACTION")
-        post_key = (to_id, post_timestamp)
-
-        if post_key in state.posts:
-            post = state.posts[post_key]
-            if action == "LIKE":
-                post['likes'].add(from_id)
-            elif action == "UNLIKE":
-                post['likes'].discard(from_id)
-
-        if to_id == args.id:
-                liker_display = state.peers.get(from_id, (from_id,))[0]
-                action_text = "likes" if action == "LIKE" else "unlikes"
-                print(f"\n{liker_display} {action_text} your post '{post['content'][:30]}...'")
-                print(f"> ", end="", flush=True)
-
-    # --- group-related messages
-    elif msg_type == "GROUP_CREATE":
-        groups.handle_group_create(msg, args)
-    elif msg_type == "GROUP_UPDATE":
-        groups.handle_group_update(msg)
-    elif msg_type == "GROUP_MESSAGE":
-        groups.handle_group_message(msg, args)
-
-    # --- tictactoe-related messages
-    elif msg_type == "TICTACTOE_INVITE":
-        tictactoe.handle_invite(msg)
-    elif msg_type == "TICTACTOE_MOVE":
-        tictactoe.handle_move(msg)
-    elif msg_type == "TICTACTOE_RESULT":
-        tictactoe.handle_result(msg)
-
-    # --- file-related messages
-    elif msg_type == "FILE_OFFER":
-        file_transfer.handle_file_offer(msg)
-    elif msg_type == "FILE_CHUNK":
-        file_transfer.handle_file_chunk(msg, sock, args)
-    elif msg_type == "FILE_RECEIVED":
-        file_transfer.handle_file_received(msg)
-    elif msg_type == "FILE ACCEPTED":
-        file_transfer.handle_file_accepted(msg, sock, args)
+    if not registry.wanted(msg_type, msg, args):
+        return
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--verbose', action='store_true', help='Enable verbose mode')
-    parser.add_argument('--name', required=True, help='Your display name')
-    parser.add_argument('--id', required=True, help='Your user ID in format user@ip')
-    args = parser.parse_args()
+    mode = registry.delivery.get(msg_type)
+    if mode and not reliable.receive(msg, addr, sock, mode, args.verbose):
+        utils.log(f"Dropped copy of {msg_type} {msg.get('MESSAGE_ID')}", "RECV", msg_type)
+        return
 
-    utils.set_verbose(args.verbose)
-    sock = create_socket()
+    if not registry.dispatch(msg_type, msg, sock, args) and args.verbose:
+        utils.log(f"No handler for message type {msg_type}", "WARN", msg_type)
+
+@register("PROFILE")
+def handle_profile(msg, sock, args):
+    user_id = msg.get("USER_ID")
+    peer = state.peers.get(user_id)
+    if peer is None:
+        return  # handle_message adds every sender, so only one without a USER_ID
+    display = msg.get("DISPLAY_NAME", user_id)
+    status = msg.get("STATUS", "")
+    changed = (display, status) != (peer.display, peer.status)
+    peer.display, peer.status = display, status
+    directory.answered(user_id, peer.addr)
+    # a PROFILE answering our PING says nothing new, only show what changed
+    if changed:
+        print(f"[PROFILE] {display} — {status}")
 
-    handler = lambda raw, addr: handle_message(raw, addr, sock, args)
-    receive_loop(sock, handler, verbose=args.verbose)
+@register("PING")
+def handle_ping(msg, sock, args):
+    # answered straight back to where the ping came from, so the pinger
+    # learns we're still here without another broadcast
+    peer = state.peers.get(msg.get("USER_ID"))
+    if peer is not None:
+        send_message(sock, directory.profile_message(args.id, args.name), peer.addr, args.verbose)
+
+@register("POST")
+def handle_post(msg, sock, args):
+    user_id = msg.get("USER_ID")
+    content = msg.get("CONTENT", "")
+    timestamp = msg.get("TIMESTAMP")
+    if user_id and timestamp:
+        post_key = (user_id, timestamp)
+        post = {
+            'content': content,
+            'likes': set()
+        }
+        # setdefault is one step, so two copies handled at once still print once
+        if state.posts.setdefault(post_key, post) is post:
+            retention.expire(state.posts, post_key, retention.post_ttl(msg), 'posts')
+            display = directory.display_name(user_id)
+            print(f"[POST] {display}: {content}")
+
+@register("DM", EXACTLY_ONCE)
+def handle_dm(msg, sock, args):
+    from_id = msg.get("FROM")
+    to_id = msg.get("TO")
+    content = msg.get("CONTENT", "")
+    retention.record_dm(from_id, (from_id, to_id, content))
+    display = directory.display_name(from_id)
+    print(f"[DM] {display} to you: {content}")
+
+@register("FOLLOW", AT_LEAST_ONCE)
+def handle_follow(msg, sock, args):
+    # a retransmitted FOLLOW may arrive twice, following again changes nothing
+    from_id = msg.get("FROM")
+    if from_id in state.followers:
+        return
+    state.followers.add(from_id)
+    display = directory.display_name(from_id)
+    print(f"User {display} has followed you")
+
+@register("UNFOLLOW")
+def handle_unfollow(msg, sock, args):
+    from_id = msg.get("FROM")
+    state.followers.discard(from_id)
+    display = directory.display_name(from_id)
+    print(f"User {display} has unfollowed you")
+
+@register("LIKE")
+def handle_like(msg, sock, args):
+    from_id = msg.get("FROM")
+    to_id = msg.get("TO")
+    post_timestamp = msg.get("POST_TIMESTAMP")
+    action = msg.get("ACTION")
+    post_key = (to_id, post_timestamp)
+
+    post = state.posts.get(post_key)
+    if post is not None:
+        if action == "LIKE":
+            post['likes'].add(from_id)
+        elif action == "UNLIKE":
+            post['likes'].discard(from_id)
+
+    # a post past retention is gone, a late like for it is ignored
+    if to_id == args.id and post is not None:
+        liker_display = directory.display_name(from_id)
+        action_text = "likes" if action == "LIKE" else "unlikes"
+        print(f"\n{liker_display} {action_text} your post '{post['content'][:30]}...'")
+        print(f"> ", end="", flush=True)
+
+def stats_lines(sock, receiver):
+    """what the stats command prints, also served at /stats with --metrics-port"""
+    lines = []
+    if isinstance(receiver, ReceiveDispatcher):
+        depths = receiver.queue_depths()
+        for pool_name in ('bulk', 'control'):
+            lines.append(f"{pool_name}: {receiver.received[pool_name]} received, "
+                         f"{receiver.dropped[pool_name]} dropped, queued per worker {depths[pool_name]}")
+    else:
+        lines.append(f"event loop: {receiver.received} received, handled inline")
+    if isinstance(receiver, shards.ShardDispatcher):
+        lines.append(f"shards: {receiver.count} workers, {receiver.forwarded} passed on, "
+                     f"{receiver.forward_dropped} lost passing on, {receiver.copies} broadcast copies dropped "
+                     f"(counts of the coordinator)")
+    lines.append(f"handler errors: {receiver.errors}")
+    lines.append(f"reliable delivery: {reliable.acked} acked, {reliable.retransmitted} resent, "
+                 f"{reliable.failed} unacknowledged, {reliable.duplicates} copies dropped")
+    if registry.unknown_types:
+        unknown = ', '.join(f"{t} ({n})" for t, n in registry.unknown_types.most_common())
+        lines.append(f"unknown message types: {unknown}")
+    lines += metrics.report()
+
+    queued = sum(job.status == 'queued' for job in list(scheduler.jobs.values()))
+    queues = socket_queues(sock)
+    socket_line = f", {queues[0] // 1024} KiB in the socket" if queues else ""
+    lines.append(f"send queue: {len(reliable.pending)} messages awaiting ack, {queued} transfers waiting{socket_line}")
+    if queues:
+        lines.append(f"socket receive buffer: {sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 1024} KiB, "
+                     f"{queues[1] // 1024} KiB unread, {queues[2]} datagrams dropped by the kernel")
+    else:
+        lines.append(f"socket receive buffer: {sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 1024} KiB")
+
+    now = time.time()
+    for job in list(scheduler.jobs.values()):
+        if job.status == 'active' and job.kind == 'send':
+            lines.append(f"upload {job.name} -> {job.peer}: {job.throughput / 1024:.1f} KiB/s")
+    for file_id, file_info in state.incoming_files.snapshot().items():
+        elapsed = now - file_info['accepted_at']
+        rate = file_info['received'] / elapsed if elapsed > 0 else 0.0
+        lines.append(f"download {file_info['metadata']['FILENAME']} ({file_id}): {rate / 1024:.1f} KiB/s, "
+                     f"{file_info['bitmap'].count}/{file_info['bitmap'].total_chunks} chunks")
+    lines += retention.report()
+    log_line = utils.report()
+    if log_line:
+        lines.append(log_line)
+    return lines
+
+def watch(sock, receiver):
+    """gauges for the /metrics endpoint"""
+    if isinstance(receiver, ReceiveDispatcher):
+        metrics.gauges['receive_queued'] = lambda: sum(map(sum, receiver.queue_depths().values()))
+        metrics.gauges['receive_dropped'] = lambda: sum(receiver.dropped.values())
+    metrics.gauges['reliable_pending'] = lambda: len(reliable.pending)
+    metrics.gauges['reliable_resent'] = lambda: reliable.retransmitted
+    metrics.gauges['transfers_waiting'] = lambda: sum(job.status == 'queued' for job in list(scheduler.jobs.values()))
+    metrics.gauges['socket_send_queue_bytes'] = lambda: socket_queues(sock)[0]
+    metrics.gauges['socket_kernel_drops'] = lambda: socket_queues(sock)[2]
+    metrics.gauges['peers'] = lambda: len(state.peers)
+    metrics.gauges['downloads'] = lambda: len(state.incoming_files)
+
+def handle_command(cmd, sock, args, receiver):
+    """runs one REPL command, returns False on quit.
+
+    receiver is the ReceiveDispatcher, or the asyncio protocol, for stats
+    """
+    if cmd.startswith("post "):
+        content = cmd[5:]
+        timestamp = str(int(time.time()))
+        post_key = (args.id, timestamp)
+        state.posts[post_key] = {
+            'content': content,
+            'likes': set()
+        }
+        retention.expire(state.posts, post_key, retention.POST_TTL, 'posts')
+        fields = {
+            "TYPE": "POST",
+            "USER_ID": args.id,
+            "CONTENT": content,
+            "TTL": retention.POST_TTL,
+            "MESSAGE_ID": new_message_id(),
+            "TOKEN": f"{args.id}|{timestamp}|broadcast"
+        }
+        send_message(sock, build_message(fields), '<broadcast>', args.verbose)
+
+    elif cmd == "ping":
+        directory.pinged()
+        send_message(sock, ping_message(args.id), "<broadcast>", args.verbose)
+
+    elif cmd.startswith("dm "):
+        parts = cmd.split(' ', 2)
+        if len(parts) == 3:
+            to_id, content = parts[1], parts[2]
+            message_id = new_message_id()
+            fields = {
+                "TYPE": "DM",
+                "FROM": args.id,
+                "TO": to_id,
+                "CONTENT": content,
+                "TIMESTAMP": "999999999",
+                "MESSAGE_ID": message_id,
+                "TOKEN": f"{args.id}|9999999999|chat"
+            }
+            addr = directory.address(to_id)
+            reliable.send(sock, build_message(fields), addr, message_id, args.verbose)
+            retention.record_dm(to_id, (args.id, to_id, content))
+
+    # --- follow / unfollow commands
+    elif cmd.startswith("follow "):
+        to_id = cmd.split(' ')[1]
+        message_id = new_message_id()
+        fields = {
+            "TYPE": "FOLLOW",
+            "MESSAGE_ID": message_id,
+            "FROM": args.id,
+            "TO": to_id,
+            "TIMESTAMP": str(int(time.time())),
+            "TOKEN": f"{args.id}|9999999999|follow"
+        }
+        addr = directory.address(to_id)
+        reliable.send(sock, build_message(fields), addr, message_id, args.verbose)
+    elif cmd.startswith("unfollow "):
+        to_id = cmd.split(' ')[1]
+        fields = {
+            "TYPE": "UNFOLLOW",
+            "MESSAGE_ID": new_message_id(),
+            "FROM": args.id,
+            "TO": to_id,
+            "TIMESTAMP": str(int(time.time())),
+            "TOKEN": f"{args.id}|9999999999|follow"
+        }
+        addr = directory.address(to_id)
+        send_message(sock, build_message(fields), addr, args.verbose)
+
+    # --- group commands
+    elif cmd.startswith("creategroup "):
+        groups.process_creategroup(cmd, sock, args)
+    elif cmd.startswith("addtogroup ") or cmd.startswith("removefromgroup "):
+        groups.process_updategroup(cmd, sock, args)
+    elif cmd.startswith("gmsg "):
+        groups.process_gmsg(cmd, sock, args)
+    elif cmd == "listgroups":
+        groups.process_listgroups(args)
+
+    # --- tictactoe commands
+    elif cmd.startswith("ttt "):
+        try:
+            _, opponent_id = cmd.split(' ', 1)
+            tictactoe.initiate_game(sock, args.id, opponent_id, args.verbose)
+        except ValueError:
+            print("Usage: ttt <user.id")
+    elif cmd.startswith("move "):
+        tictactoe.process_move(cmd, sock, args)
+
+    # --- file commands
+    elif cmd.startswith("sendfile "):
+        file_transfer.process_sendfile(cmd, sock, args)
+    elif cmd.startswith("sendfile-group "):
+        group_transfer.process_sendfile_group(cmd, sock, args)
+    elif cmd.startswith("accept ") and isinstance(receiver, shards.ShardDispatcher):
+        # the offer went to the worker that will take the download
+        receiver.command(shards.file_owner(cmd[7:].strip().encode('utf-8'), receiver.count), cmd)
+    elif cmd.startswith("accept "):
+        file_transfer.process_accept(cmd, sock, args)
+    elif cmd == "transfers":
+        scheduler.process_transfers()
+        
+    # --- liking posts
+    elif cmd.startswith("timeline"):
+        # timeline [user_id] [page]
+        author, page = None, 1
+        for part in cmd.split()[1:]:
+            if part.isdigit():
+                page = max(int(part), 1)
+            else:
+                author = part
+        posts = state.posts.page(page - 1, TIMELINE_PAGE, author)
+        pages = max((state.posts.count(author) + TIMELINE_PAGE - 1) // TIMELINE_PAGE, 1)
+        print(f"--- recent posts{f' by {author}' if author else ''} (page {page} of {pages}) ---")
+        if not posts:
+            print("No posts to show.")
+        for pid, (author_id, _), post_data in posts:
+            author_display = directory.display_name(author_id)
+            like_count = len(post_data['likes'])
+            print(f"[{pid}] {author_display}: {post_data['content']} ({like_count} likes)")
+        print("---------------------")
+    elif cmd.startswith("like ") or cmd.startswith("unlike "):
+        parts = cmd.split(' ')
+        action = "LIKE" if parts[0] == "like" else "UNLIKE"
+        post_key = state.posts.find(parts[1]) if len(parts) > 1 else None
+        if len(parts) < 2:
+            print(f"Usage: {action.lower()} <post_id>")
+        elif post_key is None:
+            print("No such post, it may have expired.")
+        else:
+            to_id, post_timestamp = post_key
+            fields = {
+                "TYPE": "LIKE",
+                "FROM": args.id,
+                "TO": to_id,
+                "POST_TIMESTAMP": post_timestamp,
+                "ACTION": action,
+                "TIMESTAMP": str(int(time.time())),
+                "TOKEN": f"{args.id}|9999999999|broadcast"
+            }
+            send_message(sock, build_message(fields), '<broadcast>', args.verbose)
+            print(f"Send {action} for post {parts[1]}")
+
+    elif cmd == "stats":
+        print("--- stats ---")
+        for line in stats_lines(sock, receiver):
+            print(line)
+        print("-------------")
+
+    elif cmd == "log" or cmd.startswith("log "):
+        parts = cmd.split()
+        lines = utils.recent(int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 50)
+        if lines is None:
+            print(f"Verbose log goes to the {utils.sink}, start with --log-sink ring to keep it here.")
+        else:
+            print('\n'.join(lines) if lines else "Nothing logged yet.")
+
+    elif cmd.split(' ')[0] == "profile":
+        if metrics.sampler is None:
+            print("Profiling is off, start the peer with --profile.")
+        elif cmd == "profile reset":
+            metrics.sampler.reset()
+            print("Profile cleared.")
+        else:
+            print(metrics.sampler.top())
+
+    elif cmd == "peers":
+        now = time.time()
+        for uid, peer in state.peers.snapshot().items():
+            rtt = f", rtt {peer.rtt * 1000:.0f} ms" if peer.rtt is not None else ""
+            print(f"{peer.display} ({uid}) — {peer.status} [{peer.addr[0]}:{peer.addr[1]}, seen {now - peer.last_seen:.0f}s ago{rtt}]")
+        if state.gone:
+            print(f"({len(state.gone)} peers left, not sent to until heard from again)")
+
+    elif cmd == "quit":
+        return False
+
+    elif cmd == "help":
+        print("Available commands:\n"
+              "  post <message>          - Post a public message.\n"
+              "  ping                    - Sends a broadcast ping .\n"
+              "  dm <user> <message>     - Sends a private message to a user.\n"
+              "  timeline [user] [page]  - View recent posts, or one user's.\n"
+              "  like <post_id>          - Like a post from the timeline.\n"
+              "  unlike <post_id>        - Unlike a post from the timeline.\n"
+              "  sendfile <user> <path>  - Offer to send a file to a user.\n"
+              "  sendfile-group <id> <path> - Send a file to every member of a group at once.\n"
+              "  accept <file_id>        - Accept a file offer.\n"
+              "  transfers               - List queued and active file transfers.\n"
+              "  creategroup <id> <name> <members> - Create a group.\n"
+              "  addtogroup <id> <members>   - Add members to a group you own.\n"
+              "  removefromgroup <id> <members> - Remove members from a group.\n"
+              "  gmsg <id> <message>       - Send a message to a group.\n"
+              "  listgroups              - List the groups you are in.\n"
+              "  ttt <user>              - Invite a user to play Tic-Tac-Toe.\n"
+              "  move <game_id> <pos>    - Make a move in a Tic-Tac-Toe game.\n"
+              "  peers                   - List all known peers.\n"
+              "  stats                   - Show traffic, handler times, queues, drops and transfer rates.\n"
+              "  log [n]                 - Show the last n verbose log lines (--log-sink ring).\n"
+              "  profile [reset]         - Show where sampled handler calls spent their time (--profile).\n"
+              "  quit                    - Exit the application.")
+
+def run_in_shard(cmd, sock, args):
+    # what a shard worker is asked to run: accepting a download offered to it
+    if cmd.startswith("accept "):
+        file_transfer.process_accept(cmd, sock, args)
+
+def run_threads(args):
+    if args.shards:
+        sock, dispatcher = shards.start(args, handle_message, run_in_shard)
+    else:
+        sock = create_socket(args.rcvbuf * 1024)
+        handler = lambda raw, addr: handle_message(raw, addr, sock, args)
+        dispatcher = ReceiveDispatcher(handler, args.recv_workers, args.recv_workers, verbose=args.verbose)
+        receive_loop(sock, handler, verbose=args.verbose, dispatcher=dispatcher, batch=args.batch_recv)
 
     # send ping periodically every 5mins
     ping_thread = threading.Thread(target = send_ping, args = (sock, args.id, args.verbose), daemon = True)
     ping_thread.start()
 
-    profile_fields = {
-        "TYPE": "PROFILE",
-        "USER_ID": args.id,
-        "DISPLAY_NAME": args.name,
-        "STATUS": "Exploring LSNP!",
-    }
-    send_message(sock, build_message(profile_fields), '<broadcast>', args.verbose)
+    start_peer(sock, args, dispatcher)
 
     print("[LSNP] Peer is running. Type 'post <msg>' or 'dm <to> <msg>' or 'quit'")
     while True:
         try:
             cmd = input("> ").strip()
-            if cmd.startswith("post "):
-                content = cmd[5:]
-                timestamp = str(int(time.time()))
-                post_key = (args.id, timestamp)
-                state.posts[post_key] = {
-                    'content': content,
-                    'likes': set()
-                }
-                fields = {
-                    "TYPE": "POST",
-                    "USER_ID": args.id,
-                    "CONTENT": content,
-                    "TTL": 3600,
-                    "MESSAGE_ID": "msgid123",
-                    "TOKEN": f"{args.id}|{timestamp}|broadcast"
-                }
-                send_message(sock, build_message(fields), '<broadcast>', args.verbose)
-
-            elif cmd == "ping":
-                ping_fields = {
-                    "TYPE": "PING",
-                    "USER_ID": args.id
-                }
-                send_message(sock, build_message(ping_fields), "<broadcast>", args.verbose)
-
-            elif cmd.startswith("dm "):
-                parts = cmd.split(' ', 2)
-                if len(parts) == 3:
-                    to_id, content = parts[1], parts[2]
-                    fields = {
-                        "TYPE": "DM",
-                        "FROM": args.id,
-                        "TO": to_id,
-                        "CONTENT": content,
-                        "TIMESTAMP": "999999999",
-                        "MESSAGE_ID": "msgid456",
-                        "TOKEN": f"{args.id}|9999999999|chat"
-                    }
-                    ip = to_id.split('@')[1]
-                    send_message(sock, build_message(fields), ip, args.verbose)
-
-            # --- follow / unfollow commands
-            elif cmd.startswith("follow "):
-                to_id = cmd.split(' ')[1]
-                fields = {
-                    "TYPE": "FOLLOW",
-                    "MESSAGE_ID": uuid.uuid4().hex[:8],
-                    "FROM": args.id,
-                    "TO": to_id,
-                    "TIMESTAMP": str(int(time.time())),
-                    "TOKEN": f"{args.id}|9999999999|follow"
-                }
-                ip = to_id.split('@')[1]
-                send_message(sock, build_message(fields), ip, args.verbose)
-            elif cmd.startswith("unfollow "):
-                to_id = cmd.split(' ')[1]
-                fields = {
-                    "TYPE": "UNFOLLOW",
-                    "MESSAGE_ID": uuid.uuid4().hex[:8],
-                    "FROM": args.id,
-                    "TO": to_id,
-                    "TIMESTAMP": str(int(time.time())),
-                    "TOKEN": f"{args.id}|9999999999|follow"
-                }
-                ip = to_id.split('@')[1]
-                send_message(sock, build_message(fields), ip, args.verbose)
-
-            # --- group commands
-            elif cmd.startswith("creategroup "):
-                groups.process_creategroup(cmd, sock, args)
-            elif cmd.startswith("addtogroup ") or cmd.startswith("removefromgroup "):
-                groups.process_updategroup(cmd, sock, args)
-            elif cmd.startswith("gmsg "):
-                groups.process_gmsg(cmd, sock, args)
-            elif cmd == "listgroups":
-                groups.process_listgroups(args)
-
-            # --- tictactoe commands
-            elif cmd.startswith("ttt "):
-                try:
-                    _, opponent_id = cmd.split(' ', 1)
-                    tictactoe.initiate_game(sock, args.id, opponent_id, args.verbose)
-                except ValueError:
-                    print("Usage: ttt <user.id")
-            elif cmd.startswith("move "):
-                tictactoe.process_move(cmd, sock, args)
-
-            # --- file commands
-            elif cmd.startswith("sendfile "):
-                file_transfer.process_sendfile(cmd, sock, args)
-            elif cmd.startswith("accept "):
-                file_transfer.process_accept(cmd, sock, args)
-                
-            # --- liking posts
-            elif cmd.startswith("timeline"):
-                print("--- recent posts ---")
-                sorted_posts = sorted(state.posts.items(), key = lambda item: int(item[0][1]), reverse = True)
-                state.timeline_cache = sorted_posts
-                if not sorted_posts:
-                    print("No posts to show.")
-                for i, (post_key, post_data) in enumerate(sorted_posts):
-                    author_id, _ = post_key
-                    author_display = state.peers.get(author_id, (author_id,))[0]
-                    like_count = len(post_data['likes'])
-                    print(f"[{i}] {author_display}: {post_data['content']} ({like_count} likes)")
-                print("---------------------")
-            elif cmd.startswith("like ") or cmd.startswith("unlike "):
-                parts = cmd.split(' ')
-                action = "LIKE" if parts[0] == "like" else "UNLIKE"
-                try:
-                    index = int(parts[1])
-                    if 0 <= index < len(state.timeline_cache):
-                        post_key, _ = state.timeline_cache[index]
-                        to_id, post_timestamp = post_key
-                        fields = {
-                            "TYPE": "LIKE",
-                            "FROM": args.id,
-                            "TO": to_id,
-                            "POST_TIMESTAMP": post_timestamp,
-                            "ACTION": action,
-                            "TIMESTAMP": str(int(time.time())),
-                            "TOKEN": f"{args.id}|9999999999|broadcast"
-                        }
-                        send_message(sock, build_message(fields), '<broadcast>', args.verbose)
-                        print(f"Send {action} for post {index}")
-                    else:
-                        print("Invalid post index.")
-                except (ValueError, IndexError):
-                    print(f"Usage: {action.lower()} <post_index")
-
-            elif cmd == "peers":
-                for uid, (name, status) in state.peers.items():
-                    print(f"{name} ({uid}) — {status}")
-
-            elif cmd == "quit":
+            if handle_command(cmd, sock, args, dispatcher) is False:
                 break
-
-            elif cmd == "help":
-                print("Available commands:\n"
-                      "  post <message>          - Post a public message.\n"
-                      "  ping                    - Sends a broadcast ping .\n"
-                      "  dm <user> <message>     - Sends a private message to a user.\n"
-                      "  timeline                - View recent posts.\n"
-                      "  like <index>            - Like a post from the timeline.\n"
-                      "  unlike <index>          - Unlike a post from the timeline.\n"
-                      "  sendfile <user> <path>  - Offer to send a file to a user.\n"
-                      "  accept <file_id>        - Accept a file offer.\n"
-                      "  creategroup <id> <name> <members> - Create a group.\n"
-                      "  addtogroup <id> <members>   - Add members to a group you own.\n"
-                      "  removefromgroup <id> <members> - Remove members from a group.\n"
-                      "  gmsg <id> <message>       - Send a message to a group.\n"
-                      "  listgroups              - List the groups you are in.\n"
-                      "  ttt <user>              - Invite a user to play Tic-Tac-Toe.\n"
-                      "  move <game_id> <pos>    - Make a move in a Tic-Tac-Toe game.\n"
-                      "  peers                   - List all known peers.\n"
-                      "  quit                    - Exit the application.")
         except KeyboardInterrupt:
             break
         except Exception as e:
             print(f"An error occurred: {e}")
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose mode')
+    parser.add_argument('--name', required=True, help='Your display name')
+    parser.add_argument('--id', required=True, help='Your user ID in format user@ip')
+    parser.add_argument('--chunk-size', type=int, help='Largest file chunk to send or accept, in bytes (e.g. 1400 to avoid fragmentation)')
+    parser.add_argument('--no-binary', action='store_true', help='Only use base64 text FILE_CHUNK messages')
+    parser.add_argument('--workers', type=int, default=4, help='File transfers that may run at the same time')
+    parser.add_argument('--max-rate', type=int, default=0, help='Total file upload rate in KiB/s (0 = unlimited)')
+    parser.add_argument('--transfer-rate', type=int, default=0, help='Upload rate per file transfer in KiB/s (0 = unlimited)')
+    parser.add_argument('--recv-workers', type=int, default=2, help='Receive worker threads per pool (file traffic / everything else)')
+    parser.add_argument('--rcvbuf', type=int, default=4096, help='Socket receive buffer in KiB (0 = system default)')
+    parser.add_argument('--batch-recv', action='store_true', help='Take every waiting datagram with one recvmmsg call (Linux, threads runtime)')
+    parser.add_argument('--batch-send', action='store_true', help='Send bursts of file chunks and group messages with one sendmmsg call (Linux, threads runtime)')
+    parser.add_argument('--chunk-cache', type=int, default=64, help='Memory for cached base64 text chunks of outgoing files, in MiB')
+    parser.add_argument('--runtime', choices=('threads', 'asyncio'), default='threads', help='Thread per task, or one asyncio event loop')
+    parser.add_argument('--shards', type=int, default=0, help='Receive with this many extra processes sharing the port, downloads split between them (Linux, threads runtime)')
+    parser.add_argument('--profile', type=int, nargs='?', const=metrics.PROFILE_EVERY, default=0, metavar='N',
+                        help=f'Profile one handler call in N (default {metrics.PROFILE_EVERY}), shown by the profile command')
+    parser.add_argument('--metrics-port', type=int, default=0, help='Serve /metrics (prometheus) and /stats over http on this local port')
+    parser.add_argument('--log-sink', default='console', metavar='SINK', help='Where --verbose logs go: console, file:PATH or ring[:LINES] (see the log command)')
+    parser.add_argument('--log-level', action='append', default=[], metavar='[TYPE=]LEVEL',
+                        help='Lowest level logged, for everything or one message TYPE: debug, info, warn, error or off (repeatable)')
+    parser.add_argument('--log-sample', action='append', default=[], metavar='TYPE=N',
+                        help=f'Log one SEND/RECV of TYPE in N (default {", ".join(f"{t}={n}" for t, n in utils.SAMPLE.items())}; repeatable)')
+    parser.add_argument('--peer-port', action='append', default=[], metavar='USER_ID=PORT', help='Port of a peer not on the default one, until it is heard from (repeatable)')
+    args = parser.parse_args()
+
+    for override in args.peer_port:
+        user_id, _, port = override.partition('=')
+        if not port.isdigit():
+            parser.error(f"--peer-port expects USER_ID=PORT, got '{override}'")
+        directory.ports[user_id] = int(port)
+
+    utils.set_verbose(args.verbose)
+    set_batch_send(args.batch_send)
+    try:
+        utils.configure(utils.parse_sink(args.log_sink), args.log_level, args.log_sample)
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    if args.profile:
+        metrics.enable_profiling(args.profile)
+    scheduler.configure(args.workers, args.max_rate * 1024, args.transfer_rate * 1024)
+    storage.chunk_cache.max_bytes = args.chunk_cache * 1024 * 1024
+
+    if args.shards and args.runtime == 'asyncio':
+        parser.error("--shards works with the threads runtime")
+    if args.runtime == 'asyncio':
+        aio_runtime.run(args, handle_message, handle_command, start_peer,
+                        lambda sock: periodic_ping(sock, args.id, args.verbose))
+    else:
+        run_threads(args)
+
 if __name__ == "__main__":
     main()
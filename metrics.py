@@ -0,0 +1,249 @@
+"""always-on counters, cheap enough to bump on every datagram.
+
+each thread adds to dicts of its own, so the hot path takes no lock and no
+thread waits on another; stats and the endpoint merge them when read.
+handler latency goes into log2 buckets of microseconds
+"""
+import cProfile
+import io
+import pstats
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from parser import BINARY_MAGIC
+
+BUCKETS = 28     # latency bucket i holds handler runs under 2**i us, the last one everything slower
+MAX_TYPES = 64   # distinct TYPE names kept apart, anything past that (a peer sending junk) is OTHER
+PROFILE_EVERY = 100  # --profile samples one handler call in this many
+
+_TYPE = re.compile(rb'^TYPE:[ \t]*(\S+)', re.M)
+
+_local = threading.local()
+_threads = []  # (traffic, latency, events) of every thread that counted anything
+_threads_lock = threading.Lock()
+_names = {}    # raw TYPE -> the name counted
+gauges = {}    # name -> func() giving its current value, for the endpoint
+sampler = None # a Sampler while --profile is on
+
+def _mine():
+    try:
+        return _local.counts
+    except AttributeError:
+        counts = _local.counts = ({}, {}, {})
+        with _threads_lock:
+            _threads.append(counts)
+        return counts
+
+def message_type(data):
+    """TYPE of an encoded message or frame, without parsing the rest of it"""
+    if data.startswith(BINARY_MAGIC):
+        return 'FILE_CHUNK'
+    if data.startswith(b'TYPE:'):
+        # how build_message and MessageTemplate lay every message out, no regex needed
+        end = data.find(b'\n')
+        raw = data[5:end if end >= 0 else len(data)].strip()
+    else:
+        match = _TYPE.search(data)
+        raw = match.group(1) if match else b'UNKNOWN'
+    name = _names.get(raw)
+    if name is None:
+        name = raw.decode('ascii', 'replace') if len(_names) < MAX_TYPES else 'OTHER'
+        _names[raw] = name
+    return name
+
+def count(direction, data, nbytes=None, packets=1):
+    """one message in or out ('in' / 'out'), of nbytes (default len(data)) per packet"""
+    traffic = _mine()[0]
+    key = (direction, message_type(data))
+    size = (len(data) if nbytes is None else nbytes) * packets
+    entry = traffic.get(key)
+    if entry is None:
+        traffic[key] = [packets, size]
+    else:
+        entry[0] += packets
+        entry[1] += size
+
+def event(name, n=1):
+    """counts something that happened: a drop, a resent chunk..."""
+    events = _mine()[2]
+    events[name] = events.get(name, 0) + n
+
+def timed(msg_type, handler, *args):
+    """runs handler(*args), recording how long it took under msg_type"""
+    start = time.perf_counter()
+    try:
+        if sampler is not None:
+            return sampler.call(handler, *args)
+        return handler(*args)
+    finally:
+        bucket = min(int((time.perf_counter() - start) * 1e6).bit_length(), BUCKETS - 1)
+        latency = _mine()[1]
+        histogram = latency.get(msg_type)
+        if histogram is None:
+            histogram = latency[msg_type] = [0] * BUCKETS
+        histogram[bucket] += 1
+
+def snapshot():
+    """(traffic, latency, events) summed over every thread"""
+    traffic, latency, events = {}, {}, {}
+    with _threads_lock:
+        counts = list(_threads)
+    for thread_traffic, thread_latency, thread_events in counts:
+        # copied first, the owning thread may add a key meanwhile
+        for key, (packets, size) in list(thread_traffic.items()):
+            entry = traffic.setdefault(key, [0, 0])
+            entry[0] += packets
+            entry[1] += size
+        for msg_type, histogram in list(thread_latency.items()):
+            total = latency.setdefault(msg_type, [0] * BUCKETS)
+            for i, n in enumerate(histogram):
+                total[i] += n
+        for name, n in list(thread_events.items()):
+            events[name] = events.get(name, 0) + n
+    return traffic, latency, events
+
+def _upper(bucket):
+    # largest handler time in bucket, in us
+    return (1 << bucket) - 1 if bucket < BUCKETS - 1 else float('inf')
+
+def quantile(histogram, q):
+    """upper bound in us of the q-th quantile of a latency histogram"""
+    rank = q * sum(histogram)
+    seen = 0
+    for bucket, n in enumerate(histogram):
+        seen += n
+        if n and seen >= rank:
+            return _upper(bucket)
+    return 0
+
+def _size(nbytes):
+    return f"{nbytes / 1024:.1f} KiB" if nbytes < 1024 * 1024 else f"{nbytes / (1024 * 1024):.1f} MiB"
+
+def _us(value):
+    return "slower" if value == float('inf') else f"{value}us" if value < 1000 else f"{value / 1000:.1f}ms"
+
+def report():
+    """lines for stats: traffic per TYPE, handler latency and counted events"""
+    traffic, latency, events = snapshot()
+    lines = []
+    for direction in ('in', 'out'):
+        rows = sorted(((entry, msg_type) for (d, msg_type), entry in traffic.items() if d == direction), reverse=True)
+        if rows:
+            lines.append(f"traffic {direction}: " + ', '.join(
+                f"{msg_type} {packets} ({_size(size)})" for (packets, size), msg_type in rows))
+    if latency:
+        lines.append("handler time (p50 / p99 / calls):")
+        for msg_type, histogram in sorted(latency.items(), key=lambda item: -sum(item[1])):
+            lines.append(f"  {msg_type:<16} {_us(quantile(histogram, 0.5)):>8} / {_us(quantile(histogram, 0.99)):>8} / {sum(histogram)}")
+    if events:
+        lines.append("events: " + ', '.join(f"{n} {name}" for name, n in sorted(events.items())))
+    if sampler is not None:
+        lines.append(f"profiled {sampler.sampled} of {sampler.calls} handler calls, see 'profile'")
+    return lines
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+def exposition():
+    """everything counted, in the prometheus text format"""
+    traffic, latency, events = snapshot()
+    out = ["# TYPE lsnp_packets_total counter"]
+    for (direction, msg_type), (packets, _) in sorted(traffic.items()):
+        out.append(f'lsnp_packets_total{{direction="{direction}",type="{_label(msg_type)}"}} {packets}')
+    out.append("# TYPE lsnp_bytes_total counter")
+    for (direction, msg_type), (_, size) in sorted(traffic.items()):
+        out.append(f'lsnp_bytes_total{{direction="{direction}",type="{_label(msg_type)}"}} {size}')
+    out.append("# TYPE lsnp_handler_seconds histogram")
+    for msg_type, histogram in sorted(latency.items()):
+        label = _label(msg_type)
+        running = 0
+        for bucket, n in enumerate(histogram[:-1]):
+            running += n
+            out.append(f'lsnp_handler_seconds_bucket{{type="{label}",le="{(1 << bucket) / 1e6:g}"}} {running}')
+        out.append(f'lsnp_handler_seconds_bucket{{type="{label}",le="+Inf"}} {sum(histogram)}')
+        out.append(f'lsnp_handler_seconds_count{{type="{label}"}} {sum(histogram)}')
+    out.append("# TYPE lsnp_events_total counter")
+    for name, n in sorted(events.items()):
+        out.append(f'lsnp_events_total{{event="{_label(name)}"}} {n}')
+    for name, func in sorted(gauges.items()):
+        try:
+            value = func()
+        except Exception:
+            continue
+        out.append(f"# TYPE lsnp_{name} gauge")
+        out.append(f"lsnp_{name} {value}")
+    return '\n'.join(out) + '\n'
+
+class Sampler:
+    """runs one handler call in every `every` under cProfile, adding up the results.
+
+    one sample at a time; a call due while another is being profiled just runs
+    """
+    def __init__(self, every=PROFILE_EVERY):
+        self.every = every
+        self.calls = 0
+        self.sampled = 0
+        self.profile = cProfile.Profile()
+        self.lock = threading.Lock()
+
+    def call(self, func, *args):
+        self.calls += 1
+        if self.calls % self.every or not self.lock.acquire(blocking=False):
+            return func(*args)
+        try:
+            self.sampled += 1
+            return self.profile.runcall(func, *args)
+        finally:
+            self.lock.release()
+
+    def top(self, limit=20, sort='cumulative'):
+        """the functions that took the most time in sampled calls, as text"""
+        out = io.StringIO()
+        with self.lock:
+            if not self.sampled:
+                return "no handler calls sampled yet\n"
+            pstats.Stats(self.profile, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def reset(self):
+        with self.lock:
+            self.profile = cProfile.Profile()
+            self.calls = self.sampled = 0
+
+def enable_profiling(every=PROFILE_EVERY):
+    global sampler
+    sampler = Sampler(max(1, every))
+
+class _Endpoint(BaseHTTPRequestHandler):
+    pages = {}  # path -> func() giving (content type, text)
+
+    def do_GET(self):
+        page = self.pages.get(self.path.split('?')[0])
+        if page is None:
+            self.send_error(404, "try /metrics or /stats")
+            return
+        content_type, text = page()
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # the REPL's terminal is no place for an access log
+
+def serve(port, stats_text, host='127.0.0.1'):
+    """answers GET /metrics (prometheus) and /stats (what the stats command prints)
+    on host:port, from a daemon thread. only local by default, the numbers
+    say a lot about who we talk to
+    """
+    _Endpoint.pages = {
+        '/metrics': lambda: ('text/plain; version=0.0.4', exposition()),
+        '/stats': lambda: ('text/plain; charset=utf-8', stats_text()),
+    }
+    server = ThreadingHTTPServer((host, port), _Endpoint)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,33 +1,393 @@
+import os
+import re
 import socket
 import threading
+import queue
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+import batchio
+import metrics
+import utils
+from parser import BINARY_MAGIC, MessageTemplate
 
 UDP_PORT = 50999
 BUFFER_SIZE = 65535
+MAX_DATAGRAM = 65507  # largest udp payload over ipv4
+RECV_QUEUE_SIZE = 2048  # datagrams waiting per receive worker before new ones are dropped
 
-def create_socket():
-    """creates and bind udp socket for broadcast"""
+# delivery modes a handler can ask for, see ReliableSender
+AT_LEAST_ONCE = "at-least-once"  # acked and retransmitted, copies may be handled again
+EXACTLY_ONCE = "exactly-once"    # also, copies with a MESSAGE_ID seen recently are dropped
+MAX_ATTEMPTS = 6      # sends of a reliable message before giving up on the peer
+DEDUP_WINDOW = 4096   # exactly-once MESSAGE_IDs remembered, far more than can be retried at once
+CONTROL_YIELD = 0.05  # longest a chunk waits for control messages being sent before it goes anyway
+MIN_RTO = 0.2         # floor of every retransmit timer: below it a briefly busy peer looks like loss, and
+                      # the whole retry span of a reliable message (63 x rto) stays long enough to ride that out
+
+# fields that name the conversation a datagram belongs to, in order of preference
+_KEY_FIELD = re.compile(rb'^(FILEID|GAMEID|GROUP_ID|FROM|USER_ID):[ \t]*(\S+)', re.M)
+
+def create_socket(rcvbuf=None, reuseport=False):
+    """creates and bind udp socket for broadcast.
+
+    with reuseport, other sockets of this user may bind UDP_PORT too and
+    the kernel spreads incoming senders across them (see shards)
+    """
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    if rcvbuf:
+        # room for bursts while the workers catch up (the kernel may cap this)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
     sock.bind(('', UDP_PORT))  # bind to all interfaces
     return sock
 
-def receive_loop(sock, handler, verbose=False):
-    """listens for incoming messages and calls the handler"""
+def socket_queues(sock):
+    """(bytes queued to send, bytes queued to read, datagrams the kernel dropped)
+    of sock, found by inode in /proc/net/udp; None where that can't be read"""
+    # a LoopSocket has no fileno of its own, so batchio never writes around its transport
+    sock = getattr(sock, 'sock', sock)
+    try:
+        inode = os.fstat(sock.fileno()).st_ino
+        with open('/proc/net/udp') as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if int(fields[9]) == inode:
+                    tx_queue, rx_queue = (int(n, 16) for n in fields[4].split(':'))
+                    return tx_queue, rx_queue, int(fields[12])
+    except (OSError, ValueError, IndexError, AttributeError, StopIteration):
+        pass
+    return None
+
+def decode_datagram(data):
+    # binary frames are handed over undecoded
+    return data if data.startswith(BINARY_MAGIC) else data.decode('utf-8')
+
+class ReceiveDispatcher:
+    """hands received datagrams to worker threads through bounded queues.
+
+    file traffic (binary frames and anything with a FILEID) and everything
+    else get separate pools, so disk writes can't hold up chat. within a pool
+    the conversation key (FILEID, GAMEID, GROUP_ID or sender) always maps to
+    the same worker, which keeps each conversation in order
+    """
+    def __init__(self, handler, bulk_workers=2, control_workers=2, queue_size=RECV_QUEUE_SIZE, verbose=False):
+        self.handler = handler
+        self.verbose = verbose
+        self.pools = {
+            'bulk': [queue.Queue(queue_size) for _ in range(max(1, bulk_workers))],
+            'control': [queue.Queue(queue_size) for _ in range(max(1, control_workers))]
+        }
+        self.received = {'bulk': 0, 'control': 0}
+        self.dropped = {'bulk': 0, 'control': 0}
+        self.errors = 0
+        for pool in self.pools.values():
+            for q in pool:
+                threading.Thread(target=self._worker, args=(q,), daemon=True).start()
+
+    def route(self, data):
+        """(pool name, conversation key) of a raw datagram, without decoding it"""
+        if data.startswith(BINARY_MAGIC):
+            return 'bulk', data[5:13]
+        fields = dict(_KEY_FIELD.findall(data))
+        if b'FILEID' in fields:
+            return 'bulk', fields[b'FILEID']
+        for name in (b'GAMEID', b'GROUP_ID', b'FROM', b'USER_ID'):
+            if name in fields:
+                return 'control', fields[name]
+        return 'control', b''
+
+    def dispatch(self, data, addr):
+        pool_name, key = self.route(data)
+        pool = self.pools[pool_name]
+        self.received[pool_name] += 1
+        try:
+            pool[zlib.crc32(key) % len(pool)].put_nowait((data, addr))
+        except queue.Full:
+            self.dropped[pool_name] += 1
+
+    def queue_depths(self):
+        return {name: [q.qsize() for q in pool] for name, pool in self.pools.items()}
+
+    def _worker(self, q):
+        while True:
+            data, addr = q.get()
+            try:
+                self.handler(decode_datagram(data), addr)
+            except Exception as e:
+                self.errors += 1
+                utils.log(f"Failed to handle message: {e}", "ERROR")
+
+def receive_loop(sock, handler, verbose=False, dispatcher=None, batch=False):
+    """listens for incoming messages and calls the handler, or queues them on a dispatcher.
+
+    with batch, everything already waiting is taken with one recvmmsg
+    """
+    receiver = batchio.BatchReceiver(sock, BUFFER_SIZE) if batch else None
     def loop():
         while True:
             try:
-                data, addr = sock.recvfrom(BUFFER_SIZE)
-                message = data.decode('utf-8')
-                handler(message, addr)
+                datagrams = receiver.recv() if receiver else (sock.recvfrom(BUFFER_SIZE),)
+                for data, addr in datagrams:
+                    metrics.count('in', data)
+                    if dispatcher is not None:
+                        dispatcher.dispatch(data, addr)
+                    else:
+                        handler(decode_datagram(data), addr)
             except Exception as e:
-                if verbose:
-                    print(f"[ERROR] Failed to receive message: {e}")
+                utils.log(f"Failed to receive message: {e}", "ERROR")
     threading.Thread(target=loop, daemon=True).start()
 
-def send_message(sock, message, ip, verbose=False):
-    sock.sendto(message.encode('utf-8'), (ip, UDP_PORT))
+# file chunks step aside while control messages (DM, PROFILE, acks, GROUP_*...) are being sent:
+# with the socket's send buffer full of chunks, a control sendto would otherwise
+# race every chunk sender for the space that frees up
+_control_pending = 0
+_control_done = threading.Condition()
+
+def _control_begin():
+    global _control_pending
+    with _control_done:
+        _control_pending += 1
+
+def _control_end():
+    global _control_pending
+    with _control_done:
+        _control_pending -= 1
+        if not _control_pending:
+            _control_done.notify_all()
+
+def _yield_to_control():
+    # called before each bulk send, the unlocked read keeps it free while nothing is pending
+    if _control_pending:
+        with _control_done:
+            _control_done.wait_for(lambda: not _control_pending, timeout=CONTROL_YIELD)
+
+def destination(dest):
+    """(ip, port) for dest: an address as directory.address gives it, or an ip or
+    "<broadcast>" that goes to UDP_PORT"""
+    return dest if type(dest) is tuple else (dest, UDP_PORT)
+
+def send_message(sock, message, dest, verbose=False):
+    """sends a text message, or an already encoded binary frame"""
+    data = message if isinstance(message, bytes) else message.encode('utf-8')
+    addr = destination(dest)
+    _control_begin()
+    try:
+        sock.sendto(data, addr)
+    finally:
+        _control_end()
+    metrics.count('out', data)
+    if verbose:
+        _log_send(addr, data)
+
+def set_batch_send(flag):
+    """sendmmsg for bursts (--batch-send). off by default, on loopback one sendmsg per
+    datagram measures faster at every size (benchmarks/bench_batchio.py)"""
+    global _send_burst
+    _send_burst = batchio.send_batch if flag else batchio.send_each
+
+_send_burst = batchio.send_each
+
+def send_to_many(sock, message, dests, verbose=False):
+    """sends one control message to several peers"""
+    data = message if isinstance(message, bytes) else message.encode('utf-8')
+    _control_begin()
+    try:
+        _send_burst(sock, [([data], destination(dest)) for dest in dests])
+    finally:
+        _control_end()
+    metrics.count('out', data, packets=len(dests))
+    if verbose:
+        for dest in dests:
+            _log_send(destination(dest), data)
+
+def _log_send(addr, data, payload=None):
+    # only queued here, the log thread decodes and shortens it if it's kept
+    extra = len(payload) if payload is not None else 0
+    utils.log(lambda: _describe_send(addr, data, extra), "SEND", metrics.message_type(data))
+
+def _describe_send(addr, data, extra):
+    dest_type = "BROADCAST" if addr[0] == "<broadcast>" else "UNICAST"
+    if data.startswith(BINARY_MAGIC):
+        message = f"<binary frame, {len(data) + extra} bytes>"
+    else:
+        message = bytes(data).decode('utf-8', 'replace')
+        if extra:
+            message += f"<{extra} more bytes>"
+    return f"({dest_type}) {addr[0]}:{addr[1]}\n{message}"
+
+def send_frame(sock, header, payload, dest, verbose=False):
+    """sends header + payload as one bulk datagram without joining them first.
+
+    used for binary chunk frames and for text chunks (message head + cached
+    DATA line). payload can be a memoryview (e.g. a slice of an mmap'd file);
+    with sendmsg the kernel gathers both buffers, elsewhere they are joined once.
+    waits for control messages being sent first
+    """
+    _yield_to_control()
+    if hasattr(sock, 'sendmsg'):
+        sock.sendmsg([header, payload], [], 0, destination(dest))
+    else:
+        sock.sendto(header + payload, destination(dest))
+    metrics.count('out', header, len(header) + len(payload))
     if verbose:
-        dest_type = "BROADCAST" if ip == "<broadcast>" else "UNICAST"
-        print(f"SEND > ({dest_type}) {ip}:{UDP_PORT}\n{message}")
+        _log_send(destination(dest), header, payload)
+
+def send_frames(sock, frames, verbose=False):
+    """send_frame for a burst of [(header, payload, dest), ...], in one sendmmsg with --batch-send"""
+    _yield_to_control()
+    _send_burst(sock, [([header, payload], destination(dest)) for header, payload, dest in frames])
+    for header, payload, _ in frames:
+        metrics.count('out', header, len(header) + len(payload))
+    if verbose:
+        for header, payload, dest in frames:
+            _log_send(destination(dest), header, payload)
+
+class RttEstimator:
+    """smoothed rtt and retransmit timeout for a peer (rfc 6298 style)"""
+    def __init__(self, initial_rto=1.0, min_rto=MIN_RTO, max_rto=10.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+
+    def backoff(self):
+        self.rto = min(self.rto * 2, self.max_rto)
+
+ACK = MessageTemplate({"TYPE": "ACK"}, ("MESSAGE_ID", "STATUS"))
+
+def new_message_id():
+    return uuid.uuid4().hex[:8]
+
+class ReliableSender:
+    """acks, retransmission and duplicate detection for messages with a MESSAGE_ID.
+
+    a message is sent again until every peer it went to acks it, each retry
+    waiting twice as long as the last, starting from that peer's rto. only
+    acks of messages sent once are rtt samples, since an ack of a retried
+    one can't say which copy it answers
+    """
+    def __init__(self, max_attempts=MAX_ATTEMPTS, window=DEDUP_WINDOW):
+        self.max_attempts = max_attempts
+        self.window = window
+        self.cond = threading.Condition()
+        self.pending = {}         # (MESSAGE_ID, (ip, port)) -> [data, sock, sent_at, attempts, deadline, verbose]
+        self.peers = {}           # (ip, port) -> RttEstimator
+        self.seen = OrderedDict() # (FROM, MESSAGE_ID) of exactly-once messages already handled
+        self.thread = None
+        self.acked = 0
+        self.retransmitted = 0
+        self.failed = 0
+        self.duplicates = 0
+
+    def send(self, sock, message, dest, message_id, verbose=False):
+        """sends message to dest, and again until it acks message_id"""
+        self.send_many(sock, message, [dest], message_id, verbose)
+
+    def send_many(self, sock, message, dests, message_id, verbose=False, broadcast=False):
+        """send for one message going to several peers, each acking it on its own.
+
+        with broadcast it goes out once to everyone, and only the peers that
+        don't ack it get it again, by unicast
+        """
+        data = message if isinstance(message, bytes) else message.encode('utf-8')
+        # keyed by full address, the one its acks come back from
+        addrs = [destination(dest) for dest in dests]
+        now = time.time()
+        with self.cond:
+            # registered first, the ack can beat send_message back
+            for addr in addrs:
+                rto = self.peers.setdefault(addr, RttEstimator()).rto
+                self.pending[(message_id, addr)] = [data, sock, now, 0, now + rto, verbose]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._retransmit_loop, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        if broadcast:
+            send_message(sock, data, "<broadcast>", verbose)
+        elif len(addrs) == 1:
+            send_message(sock, data, addrs[0], verbose)
+        elif addrs:
+            send_to_many(sock, data, addrs, verbose)
+
+    def acknowledged(self, message_id, addr):
+        """an ACK for message_id came from addr"""
+        with self.cond:
+            entry = self.pending.pop((message_id, addr), None)
+            if entry is None:
+                return  # the ack of a copy, the first one already cleared it
+            self.acked += 1
+            if not entry[3]:
+                self.peers[addr].sample(time.time() - entry[2])
+
+    def rtt_sample(self, addr, rtt):
+        """an rtt measured some other way, e.g. a PING answered by a PROFILE"""
+        with self.cond:
+            self.peers.setdefault(addr, RttEstimator()).sample(rtt)
+
+    def receive(self, msg, addr, sock, mode, verbose=False):
+        """acks a received message, returns False if it's a copy to drop"""
+        message_id = msg.get("MESSAGE_ID")
+        if not message_id:
+            return True
+        # ack every copy, the ack of the first one may be what got lost
+        send_message(sock, ACK.render(message_id, "RECEIVED"), addr, verbose)
+        if mode != EXACTLY_ONCE:
+            return True
+        key = (msg.get("FROM") or addr[0], message_id)
+        with self.cond:
+            if key in self.seen:
+                self.duplicates += 1
+                return False
+            self.seen[key] = None
+            if len(self.seen) > self.window:
+                self.seen.popitem(last=False)
+        return True
+
+    def _retransmit_loop(self):
+        while True:
+            resend = []
+            gave_up = []
+            with self.cond:
+                now = time.time()
+                for key, entry in list(self.pending.items()):
+                    data, sock, sent_at, attempts, deadline, verbose = entry
+                    if deadline > now:
+                        continue
+                    if attempts + 1 >= self.max_attempts:
+                        del self.pending[key]
+                        self.failed += 1
+                        gave_up.append(key)
+                        continue
+                    rtt = self.peers[key[1]]
+                    entry[2:5] = [now, attempts + 1, now + min(rtt.rto * 2 ** (attempts + 1), rtt.max_rto)]
+                    resend.append((sock, data, key[1], verbose))
+                self.retransmitted += len(resend)
+                if not resend and not gave_up:
+                    deadlines = [entry[4] for entry in self.pending.values()]
+                    self.cond.wait(min(deadlines) - now if deadlines else None)
+                    continue
+            for sock, data, addr, verbose in resend:
+                try:
+                    send_message(sock, data, addr, verbose)
+                except OSError as e:
+                    utils.log(f"Failed to resend message to {addr[0]}:{addr[1]}: {e}", "ERROR")
+            for message_id, (ip, port) in gave_up:
+                print(f"[WARN] {ip}:{port} did not acknowledge message {message_id} after {self.max_attempts} tries")
 
+reliable = ReliableSender()
@@ -1,14 +1,86 @@
+import re
+import struct
+
+# binary FILE_CHUNK frame: fixed header followed by the raw chunk bytes.
+# text LSNP messages never start with a NUL byte, so the magic can't collide
+BINARY_MAGIC = b'\x00LSNP'
+CHUNK_FRAME = struct.Struct('!5s8sIII')  # magic, FILEID, CHUNK_INDEX, TOTAL_CHUNKS, CRC32
+
 def build_message(fields):
     """builds a LSNP message from a dict of fields"""
     return ''.join(f"{k}: {v}\n" for k, v in fields.items()) + "\n"
 
+class MessageTemplate:
+    """a message whose leading fields are the same on every send.
+
+    those are serialized and encoded once; render() only formats the fields
+    that change, in the order named by `varying`, and returns bytes that
+    send_message sends as they are
+    """
+    __slots__ = ('prefix', 'format')
+
+    def __init__(self, fixed, varying=()):
+        self.prefix = ''.join(f"{k}: {v}\n" for k, v in fixed.items()).encode('utf-8')
+        self.format = ''.join(f"{k}: %s\n" for k in varying)
+
+    def render(self, *values):
+        return self.render_head(*values) + b'\n'
+
+    def render_head(self, *values):
+        """render without the blank line ending the message, for a last field sent as its own buffer"""
+        if not values:
+            return self.prefix
+        return self.prefix + (self.format % values).encode('utf-8')
+
+SPLIT_DATA_OVER = 1024  # below this, splitting every line costs less than finding DATA first (bench_parser)
+
+# TYPE and the sender as build_message lays them out, on the first two lines
+_HEAD = re.compile(r'TYPE:[ \t]*(\S*)[ \t]*\n(?:USER_ID|FROM):[ \t]*(\S*)')
+
+def peek(raw):
+    """(TYPE, sender) from the start of a raw message without parsing the rest,
+    None if it isn't laid out that way. enough to drop our own broadcasts"""
+    match = _HEAD.match(raw)
+    return match.groups() if match else None
+
+def _parse_lines(text, fields):
+    for line in text.split('\n'):
+        k, sep, v = line.partition(':')
+        if sep:
+            fields[k.strip()] = v.strip()
+
 def parse_message(raw):
-    """parse raw LSNP message into a dict"""
-    lines = raw.strip().split('\n')
+    """parse raw LSNP message into a dict of its fields.
+
+    DATA is the one field that can be tens of KB and senders put it last, so
+    in a large message only the lines around it are split up and its value is
+    sliced out of raw once, instead of being copied by every strip and split
+    """
     msg = {}
-    for line in lines:
-        if ':' not in line:
-            continue
-        k, v = line.split(':', 1)
-        msg[k.strip()] = v.strip()
+    head = raw.find('\nDATA:') if len(raw) > SPLIT_DATA_OVER else -1
+    if head < 0:
+        # _parse_lines written out, a call per message shows on small ones
+        for line in raw.split('\n'):
+            k, sep, v = line.partition(':')
+            if sep:
+                msg[k.strip()] = v.strip()
+        return msg
+    tail = raw.find('\n', head + 1)
+    if tail < 0:
+        tail = len(raw)
+    _parse_lines(raw[:head], msg)
+    msg['DATA'] = raw[head + 6:tail].strip()
+    if tail < len(raw):
+        _parse_lines(raw[tail:], msg)
     return msg
+
+def chunk_frame_header(file_id, chunk_index, total_chunks, crc):
+    """the fixed header of a binary FILE_CHUNK frame, the raw chunk bytes follow it"""
+    return CHUNK_FRAME.pack(BINARY_MAGIC, file_id.encode('ascii'), chunk_index, total_chunks, crc)
+
+def parse_chunk_frame(raw):
+    """parse a binary FILE_CHUNK frame into (file_id, chunk_index, total_chunks, crc, data)"""
+    magic, file_id, chunk_index, total_chunks, crc = CHUNK_FRAME.unpack_from(raw)
+    if magic != BINARY_MAGIC:
+        raise ValueError("not a binary chunk frame")
+    return file_id.decode('ascii'), chunk_index, total_chunks, crc, memoryview(raw)[CHUNK_FRAME.size:]
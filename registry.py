@@ -0,0 +1,44 @@
+import re
+import metrics
+from collections import Counter
+
+TYPE_NAME = re.compile(r'^[A-Z][A-Z0-9_]*$')
+
+handlers = {}             # TYPE -> handler(msg, sock, args)
+delivery = {}             # TYPE -> network.AT_LEAST_ONCE or EXACTLY_ONCE, for TYPEs that get acked
+filters = {}              # TYPE -> wanted(msg, args), for TYPEs that can arrive by broadcast
+unknown_types = Counter() # TYPEs that arrived with no handler registered
+
+def register(msg_type, delivery_mode=None, only_if=None):
+    """decorator that makes func(msg, sock, args) the handler for one message TYPE.
+
+    with a delivery_mode, messages of that TYPE carrying a MESSAGE_ID are
+    acked, and under exactly-once their retransmitted copies never reach func.
+    messages only_if(msg, args) turns down are ignored before that
+    """
+    if not TYPE_NAME.match(msg_type):
+        raise ValueError(f"Invalid message type name: {msg_type!r}")
+    def decorator(func):
+        if msg_type in handlers:
+            raise ValueError(f"{msg_type} already handled by {handlers[msg_type].__qualname__}")
+        handlers[msg_type] = func
+        if delivery_mode:
+            delivery[msg_type] = delivery_mode
+        if only_if:
+            filters[msg_type] = only_if
+        return func
+    return decorator
+
+def wanted(msg_type, msg, args):
+    """False for a message meant for other peers"""
+    only_if = filters.get(msg_type)
+    return only_if is None or only_if(msg, args)
+
+def dispatch(msg_type, msg, sock, args):
+    """runs the handler for msg_type, returns False if there is none"""
+    handler = handlers.get(msg_type)
+    if handler is None:
+        unknown_types[msg_type] += 1
+        return False
+    metrics.timed(msg_type, handler, msg, sock, args)
+    return True
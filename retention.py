@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from collections import deque
+import state
+
+POST_TTL = 3600          # seconds a post is kept when it doesn't carry a TTL
+MAX_POST_TTL = 24 * 3600 # a peer can't pin its posts in our memory for longer
+DM_HISTORY = 200         # messages kept per conversation
+DM_CONVERSATIONS = 256   # conversations kept, the least recently active goes first
+OFFER_TTL = 600          # an unanswered file offer, ours or a peer's
+STALLED_DOWNLOAD = 300   # seconds without a new chunk before a download is closed
+COMPLETED_TTL = 600      # finished file ids still answer late chunks this long
+
+class TimerWheel:
+    """a hashed timer wheel: scheduling and expiry cost the same for one timer or a million.
+
+    a timer lands in the slot of its deadline tick; one more than a turn
+    away just stays in its slot for the extra rounds. callbacks run on the
+    wheel's own thread, never under its lock
+    """
+    def __init__(self, slots=512, tick=1.0):
+        self.slots = [[] for _ in range(slots)]  # (deadline tick, callback, args)
+        self.tick = tick
+        self.current = int(time.time() / tick)   # last tick fired
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pending = 0
+        self.fired = 0
+
+    def schedule(self, delay, callback, *args):
+        """calls callback(*args) about delay seconds from now"""
+        with self.lock:
+            due = max(int((time.time() + delay) / self.tick), self.current + 1)
+            self.slots[due % len(self.slots)].append((due, callback, args))
+            self.pending += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def advance(self, now):
+        """fires every timer due by now"""
+        fire = []
+        with self.lock:
+            target = int(now / self.tick)
+            # after a long stall (e.g. a suspended laptop) one pass over the wheel covers it
+            for step in range(1, min(target - self.current, len(self.slots)) + 1):
+                index = (self.current + step) % len(self.slots)
+                slot = self.slots[index]
+                if slot:
+                    self.slots[index] = [timer for timer in slot if timer[0] > target]
+                    fire += [timer for timer in slot if timer[0] <= target]
+            self.current = max(self.current, target)
+            self.pending -= len(fire)
+            self.fired += len(fire)
+        for _, callback, args in fire:
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"[ERROR] Expiry of {args[:1]} failed: {e}")
+
+    def _run(self):
+        while True:
+            time.sleep(self.tick)
+            self.advance(time.time())
+
+wheel = TimerWheel()
+expired = {}  # what -> entries dropped so far
+
+def count(what):
+    expired[what] = expired.get(what, 0) + 1
+
+def _drop(table, key, value, what):
+    # only if key still holds the same entry, a newer one gets its own timer
+    with table.lock(key):
+        if table.get(key) is not value:
+            return
+        del table[key]
+    count(what)
+
+def expire(table, key, delay, what):
+    """drops table[key] after delay seconds, unless it was replaced or removed by then"""
+    wheel.schedule(delay, _drop, table, key, table.get(key), what)
+
+def post_ttl(msg):
+    try:
+        ttl = int(msg.get("TTL", POST_TTL))
+    except ValueError:
+        ttl = POST_TTL
+    return min(max(ttl, 0), MAX_POST_TTL)
+
+def token_ttl(msg, default):
+    """seconds until msg's TOKEN runs out (USER|EXPIRY|SCOPE), at most default"""
+    try:
+        expiry = int(msg.get("TOKEN", "").split('|')[1])
+    except (IndexError, ValueError):
+        return default
+    return min(max(expiry - time.time(), 0), default)
+
+def record_dm(peer_id, entry):
+    """adds a DM to the conversation with peer_id, keeping the last DM_HISTORY"""
+    # popped and put back, so the table stays in least recently active order
+    with state.dms.lock(peer_id):
+        history = state.dms.pop(peer_id, None)
+        if history is None:
+            history = deque(maxlen=DM_HISTORY)
+        history.append(entry)
+        state.dms[peer_id] = history
+    while len(state.dms) > DM_CONVERSATIONS:
+        try:
+            state.dms.pop(next(iter(state.dms)), None)
+        except (StopIteration, RuntimeError):  # emptied or changed meanwhile, the next DM retries
+            break
+
+def rss():
+    """resident memory of this process in bytes, None where it can't be read"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # the peak rather than the current size, but it shows growth all the same
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return None
+
+def report():
+    """lines describing what is held in memory, for stats"""
+    messages = sum(len(history) for history in state.dms.snapshot().values())
+    lines = [
+        f"held: {len(state.peers)} peers ({len(state.gone)} departed), {len(state.posts)} posts, {len(state.dms)} DM conversations ({messages} messages), "
+        f"{len(state.file_offers)} offers received, {len(state.outgoing_files)} offers sent, "
+        f"{len(state.incoming_files)} downloads, {len(state.completed_files) + len(state.completed_group_files)} finished file ids",
+        f"timers: {wheel.pending} pending, {wheel.fired} fired",
+    ]
+    if expired:
+        lines.append("expired: " + ', '.join(f"{n} {what}" for what, n in sorted(expired.items())))
+    size = rss()
+    if size is not None:
+        lines.append(f"resident memory: {size / (1024 * 1024):.1f} MiB")
+    return lines
@@ -0,0 +1,142 @@
+import itertools
+import queue
+import threading
+import time
+
+MAX_FINISHED_JOBS = 20  # finished jobs still listed by the transfers command
+
+class TokenBucket:
+    """paces bytes to a rate (bytes/s), a rate of 0 means unlimited"""
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        """takes nbytes from the bucket, returns how long to wait before sending them"""
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.time()
+            # allow at most one second worth of burst
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.rate)
+            self.updated = now
+            self.tokens -= nbytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class Job:
+    """one offer or chunk-sending task run by the scheduler"""
+    def __init__(self, job_id, kind, peer, name, total_bytes, transfer_rate):
+        self.id = job_id
+        self.kind = kind
+        self.peer = peer
+        self.name = name
+        self.total_bytes = total_bytes
+        self.bytes_sent = 0
+        self.status = 'queued'
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.bucket = TokenBucket(transfer_rate)
+
+    @property
+    def throughput(self):
+        """bytes per second since the job started running"""
+        if not self.started_at:
+            return 0.0
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return self.bytes_sent / elapsed if elapsed > 0 else 0.0
+
+workers = 4
+transfer_rate = 0
+global_bucket = TokenBucket()
+jobs = {}  # job id -> Job, active and queued plus the last few finished ones
+_queue = queue.PriorityQueue()
+_ids = itertools.count(1)
+_started = 0
+_lock = threading.Lock()
+_runner = None  # replaces the worker threads, see set_runner
+
+def configure(max_workers=4, max_rate=0, per_transfer_rate=0):
+    """sets the worker pool size and the global / per-transfer rates in bytes/s"""
+    global workers, transfer_rate
+    workers = max(1, max_workers)
+    transfer_rate = per_transfer_rate
+    global_bucket.rate = max_rate
+    global_bucket.tokens = float(max_rate)
+
+def set_runner(runner):
+    """hands jobs to runner(priority, job, func, args) instead of the worker threads"""
+    global _runner
+    _runner = runner
+
+def submit(kind, peer, name, func, args, total_bytes=0):
+    """queues func(*args, job=job); smaller jobs are started first"""
+    global _started
+    with _lock:
+        job = Job(next(_ids), kind, peer, name, total_bytes, transfer_rate)
+        jobs[job.id] = job
+        # offers only hash and send one message, run them ahead of bulk sends
+        priority = 0 if kind == 'offer' else total_bytes
+        if _runner:
+            _runner(priority, job, func, args)
+            return job
+        _queue.put((priority, job.id, job, func, args))
+        while _started < workers:
+            threading.Thread(target=_worker, daemon=True).start()
+            _started += 1
+    return job
+
+def throttle_delay(job, nbytes):
+    """charges a datagram of a job to its budgets, returns how long to wait before sending it"""
+    if job is None:
+        return 0
+    job.bytes_sent += nbytes
+    return max(job.bucket.reserve(nbytes), global_bucket.reserve(nbytes))
+
+def throttle(job, nbytes):
+    """called before each datagram of a job, blocks to keep it within its budgets"""
+    delay = throttle_delay(job, nbytes)
+    if delay:
+        time.sleep(delay)
+
+def job_started(job):
+    job.status = 'active'
+    job.started_at = time.time()
+
+def job_finished(job, ok, error=None):
+    job.status = 'failed' if ok is False or error else 'done'
+    if error:
+        print(f"[ERROR] Transfer job {job.id} failed: {error}")
+    job.finished_at = time.time()
+    _prune()
+
+def _worker():
+    while True:
+        _, _, job, func, args = _queue.get()
+        job_started(job)
+        try:
+            job_finished(job, func(*args, job=job))
+        except Exception as e:
+            job_finished(job, False, e)
+
+def _prune():
+    with _lock:
+        finished = [j for j in jobs.values() if j.finished_at]
+        finished.sort(key=lambda j: j.finished_at)
+        for j in finished[:-MAX_FINISHED_JOBS]:
+            del jobs[j.id]
+
+def process_transfers():
+    # processes "transfers" cmd
+    print("--- transfers ---")
+    if not jobs:
+        print("No queued or active transfers.")
+    for job in sorted(list(jobs.values()), key=lambda j: j.id):
+        progress = f"{job.bytes_sent // 1024} KiB sent"
+        if job.total_bytes:
+            progress += f" ({job.total_bytes // 1024} KiB file)"
+        print(f"[{job.id}] {job.kind:<5} {job.status:<7} {job.name} -> {job.peer}  "
+              f"{progress}  {job.throughput / 1024:.1f} KiB/s")
+    print("-----------------")
@@ -0,0 +1,157 @@
+"""sharded receive: several processes sharing UDP_PORT through SO_REUSEPORT.
+
+the kernel hands each sender's datagrams to one of the sockets, so every
+process also routes what it gets: downloads (FILE_OFFER, FILE_CHUNK,
+FILE_END and binary frames) belong to the worker picked by their FILEID,
+everything else to the coordinator, which keeps the REPL, the peer
+directory, posts, groups, games and the files we send. datagrams for
+another process are passed on over a unix socket.
+
+a broadcast reaches every socket in the group, so each process drops a
+datagram it already took from another path a moment ago
+"""
+import multiprocessing
+import os
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from network import create_socket, receive_loop, ReceiveDispatcher, BUFFER_SIZE, MIN_RTO
+from parser import BINARY_MAGIC, CHUNK_FRAME
+
+COORDINATOR = -1
+DOWNLOAD_TYPES = (b'FILE_OFFER', b'FILE_CHUNK', b'FILE_END')
+# broadcast copies arrive within this (the forward over the unix socket). a resend
+# is byte for byte the same datagram, frames carry no transmission seq, so the
+# window stays well under the smallest rto; a resend that still falls inside it
+# is only dropped once, the next one comes an rto later
+COPY_WINDOW = MIN_RTO / 4
+FORWARD = struct.Struct('!4sH')  # original sender ip, port; 0.0.0.0:0 carries a command
+COMMAND = FORWARD.pack(bytes(4), 0)
+
+_FILE_FIELDS = re.compile(rb'^(TYPE|FILEID):[ \t]*(\S+)', re.M)
+
+def _inbox_name(family, index):
+    # abstract unix socket names, gone with the processes
+    return f"\0lsnp-{family}-{index}".encode('ascii')
+
+def file_owner(file_id, count):
+    """the worker holding the download file_id (bytes)"""
+    return zlib.crc32(file_id) % count
+
+def owner(data, count):
+    """the process a datagram belongs to: a worker number, or COORDINATOR"""
+    if data.startswith(BINARY_MAGIC):
+        return file_owner(data[5:13], count)
+    fields = dict(_FILE_FIELDS.findall(data))
+    if fields.get(b'TYPE') not in DOWNLOAD_TYPES or b'FILEID' not in fields:
+        return COORDINATOR
+    return file_owner(fields[b'FILEID'], count)
+
+class ShardDispatcher(ReceiveDispatcher):
+    """a ReceiveDispatcher for one process of a sharded peer.
+
+    handles what belongs to index here and passes the rest on. on_command
+    runs REPL commands the coordinator sends over (accept, for a worker)
+    """
+    def __init__(self, handler, index, count, family, bulk_workers=2, control_workers=2,
+                 verbose=False, on_command=None, rcvbuf=None):
+        super().__init__(handler, bulk_workers, control_workers, verbose=verbose)
+        self.index = index
+        self.count = count
+        self.family = family
+        self.on_command = on_command
+        self.recent = OrderedDict()  # (addr, digest) -> when it was taken
+        self.lock = threading.Lock()
+        self.copies = 0
+        self.forwarded = 0
+        self.forward_dropped = 0
+        self.inbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if rcvbuf:
+            self.inbox.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.inbox.bind(_inbox_name(family, index))
+        self.outbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.outbox.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * BUFFER_SIZE)
+        threading.Thread(target=self._inbox_loop, daemon=True).start()
+
+    def dispatch(self, data, addr):
+        target = owner(data, self.count)
+        if target == self.index:
+            self.take(data, addr)
+        else:
+            self.send_to(target, FORWARD.pack(socket.inet_aton(addr[0]), addr[1]) + data)
+
+    def send_to(self, target, packet):
+        try:
+            # never blocks: a process that can't keep up loses datagrams, like a full queue
+            self.outbox.sendto(packet, socket.MSG_DONTWAIT, _inbox_name(self.family, target))
+            self.forwarded += 1
+        except OSError:
+            self.forward_dropped += 1
+
+    def command(self, target, cmd):
+        """runs a REPL command in process target"""
+        self.send_to(target, COMMAND + cmd.encode('utf-8'))
+
+    def take(self, data, addr):
+        # a chunk frame's header already holds its crc, text is hashed whole
+        digest = data[:CHUNK_FRAME.size] if data.startswith(BINARY_MAGIC) else zlib.crc32(data)
+        key = (addr, digest)
+        now = time.monotonic()
+        with self.lock:
+            while self.recent and next(iter(self.recent.values())) < now - COPY_WINDOW:
+                self.recent.popitem(last=False)
+            if key in self.recent:
+                self.copies += 1
+                return
+            self.recent[key] = now
+        super().dispatch(data, addr)
+
+    def _inbox_loop(self):
+        self.inbox.settimeout(1.0)
+        while True:
+            try:
+                packet = self.inbox.recv(FORWARD.size + BUFFER_SIZE)
+            except socket.timeout:
+                # a worker doesn't outlive its coordinator, even one that was killed
+                if self.index != COORDINATOR and os.getppid() != self.family:
+                    os._exit(0)
+                continue
+            if packet.startswith(COMMAND):
+                if self.on_command is not None:
+                    try:
+                        self.on_command(packet[FORWARD.size:].decode('utf-8'))
+                    except Exception as e:
+                        print(f"[ERROR] Command failed in shard {self.index}: {e}")
+                continue
+            ip, port = FORWARD.unpack_from(packet)
+            self.take(packet[FORWARD.size:], (socket.inet_ntoa(ip), port))
+
+def _worker(index, args, on_message, on_command, family):
+    sock = create_socket(args.rcvbuf * 1024, reuseport=True)
+    dispatcher = ShardDispatcher(lambda raw, addr: on_message(raw, addr, sock, args), index, args.shards, family,
+                                 args.recv_workers, args.recv_workers, args.verbose,
+                                 lambda cmd: on_command(cmd, sock, args), args.rcvbuf * 1024)
+    receive_loop(sock, None, verbose=args.verbose, dispatcher=dispatcher, batch=args.batch_recv)
+    while True:
+        time.sleep(3600)
+
+def start(args, on_message, on_worker_command):
+    """starts args.shards worker processes, then returns the coordinator's socket and dispatcher"""
+    if not hasattr(socket, 'SO_REUSEPORT') or not sys.platform.startswith('linux'):
+        raise SystemExit("--shards needs Linux (SO_REUSEPORT)")
+    family = os.getpid()
+    # forked before this process starts any threads of its own
+    context = multiprocessing.get_context('fork')
+    for index in range(args.shards):
+        context.Process(target=_worker, args=(index, args, on_message, on_worker_command, family),
+                        daemon=True).start()
+    sock = create_socket(args.rcvbuf * 1024, reuseport=True)
+    dispatcher = ShardDispatcher(lambda raw, addr: on_message(raw, addr, sock, args), COORDINATOR, args.shards, family,
+                                 args.recv_workers, args.recv_workers, args.verbose, rcvbuf=args.rcvbuf * 1024)
+    receive_loop(sock, None, verbose=args.verbose, dispatcher=dispatcher, batch=args.batch_recv)
+    return sock, dispatcher
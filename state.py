@@ -1,10 +1,125 @@
-peers = {}  # USER_ID -> display_name, status
+import bisect
+import hashlib
+import threading
+
+class Table(dict):
+    """a dict shared by the receive workers, transfer threads and the REPL.
+
+    a single get, set or pop is atomic already. an update that reads an
+    entry and then changes it holds lock(key), one of a few locks picked by
+    the key's hash, so updates to other keys carry on meanwhile. readers
+    that loop over the table go through snapshot()
+    """
+    STRIPES = 16
+    __slots__ = ('locks',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.locks = [threading.RLock() for _ in range(self.STRIPES)]
+
+    def lock(self, key):
+        return self.locks[hash(key) % self.STRIPES]
+
+    def snapshot(self):
+        """a plain copy to iterate over while other threads change the table"""
+        # one C-level copy under the gil, so never half-way through an update
+        return dict(self)
+
+def post_id(key):
+    """a short name for the post (USER_ID, TIMESTAMP), the same on every peer.
+    64 bits, a crc32 already collides every few thousand posts"""
+    return hashlib.blake2b('|'.join(key).encode('utf-8'), digest_size=8).hexdigest()
+
+def _when(key):
+    try:
+        return int(key[1])
+    except ValueError:
+        return 0
+
+class Timeline(Table):
+    """the posts table, with an index kept in time order as posts come and go.
+
+    page() reads the newest posts without sorting anything, for everyone or
+    one author, and find() looks a post up by post_id, so a like names the
+    post itself rather than its place in a list that may have moved since
+    """
+    __slots__ = ('order', 'authors', 'ids', 'index_lock')
+
+    def __init__(self):
+        super().__init__()
+        self.order = []    # (time, USER_ID, TIMESTAMP), oldest first
+        self.authors = {}  # USER_ID -> the same for that author's posts
+        self.ids = {}      # post_id -> key
+        self.index_lock = threading.Lock()
+
+    def _index(self, key):
+        entry = (_when(key), *key)
+        bisect.insort(self.order, entry)
+        bisect.insort(self.authors.setdefault(key[0], []), entry)
+        self.ids[post_id(key)] = key
+
+    def _unindex(self, key):
+        entry = (_when(key), *key)
+        for order in (self.order, self.authors[key[0]]):
+            del order[bisect.bisect_left(order, entry)]
+        if not self.authors[key[0]]:
+            del self.authors[key[0]]
+        if self.ids.get(post_id(key)) == key:
+            del self.ids[post_id(key)]
+
+    def __setitem__(self, key, post):
+        with self.index_lock:
+            if key not in self:
+                self._index(key)
+            super().__setitem__(key, post)
+
+    def setdefault(self, key, post):
+        with self.index_lock:
+            if key not in self:
+                self._index(key)
+            return super().setdefault(key, post)
+
+    def __delitem__(self, key):
+        with self.index_lock:
+            super().__delitem__(key)
+            self._unindex(key)
+
+    def pop(self, key, *default):
+        with self.index_lock:
+            if key not in self:
+                return super().pop(key, *default)
+            self._unindex(key)
+            return super().pop(key)
+
+    def count(self, author=None):
+        return len(self.order if author is None else self.authors.get(author, ()))
+
+    def page(self, number=0, size=20, author=None):
+        """[(post_id, key, post)] of page number, newest first"""
+        with self.index_lock:
+            order = self.order if author is None else self.authors.get(author, [])
+            end = max(len(order) - number * size, 0)
+            entries = order[max(end - size, 0):end]
+            return [(post_id(key), key, self[key]) for key in
+                    (entry[1:] for entry in reversed(entries))]
+
+    def find(self, pid):
+        """the key of the post named pid, None if there's no such post (any more)"""
+        return self.ids.get(pid)
+
+peers = Table()  # USER_ID -> directory.Peer, removed after PEER_TTL of silence
+gone = Table()   # USER_ID -> last seen, for peers swept out of peers
+followers = set() # USER_IDs following you
 # posts = []  # list of {user_id, content}
-dms = []    # list of {from, to, content}
-file_offers = {} # FILE_ID -> from, filename
-incoming_files = {} # FILE_ID -> metadata, received_chunks
-posts = {}
-groups = {}
-tictactoe_games = {}
-pending_file_sends = {}
-outgoing_files = {}
\ No newline at end of file
+dms = Table()    # peer USER_ID -> deque of the last (from, to, content) with them
+file_offers = Table() # FILE_ID -> from, filename
+incoming_files = Table() # FILE_ID -> metadata, partial file on disk, chunk bitmap
+posts = Timeline() # (USER_ID, TIMESTAMP) -> content, likes
+groups = Table() # GROUP_ID -> name, creator, members (a set that's replaced, never changed in place)
+tictactoe_games = Table()
+pending_file_sends = Table()
+outgoing_files = Table()
+active_sends = Table() # FILE_ID -> SendWindow of a transfer in progress
+completed_files = Table() # FILE_ID -> sender of a file fully received, so late chunks still get acked
+completed_group_files = Table() # FILE_ID -> sender, for group downloads answered only on FILE_END
+group_sends = Table() # FILE_ID -> state of a sendfile-group distribution
@@ -0,0 +1,227 @@
+import os
+import base64
+import glob
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from integrity import TreeHasher, num_leaves
+
+PROGRESS_SUFFIX = '.progress.json'
+CONTENT_INDEX = '.content_index.json'
+HASH_BLOCK = 1024 * 1024
+
+_hash_cache = {}  # (path, size, mtime) -> digests, so re-offering a file doesn't rehash it
+_content_index = {}  # download dir -> {sha256: path of a finished download}
+
+def file_digests(path):
+    """(sha256, tree hash) of a file's contents, both from a single read.
+
+    the sha256 recognises the same file across offers, the tree hash lets a
+    receiver verify chunks as they land in any order
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if key in _hash_cache:
+        return _hash_cache[key]
+    digest = hashlib.sha256()
+    tree = TreeHasher(num_leaves(st.st_size))
+    with open(path, 'rb') as f:
+        for block_index, block in enumerate(iter(lambda: f.read(HASH_BLOCK), b'')):
+            digest.update(block)
+            tree.add_chunk(block_index, HASH_BLOCK, block)
+    _hash_cache[key] = (digest.hexdigest(), tree.root())
+    return _hash_cache[key]
+
+class ChunkCache:
+    """lru cache of encoded text chunks keyed by (content hash, chunk size, index).
+
+    binary frames are slices of the mmap'd file and never go through it"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+
+chunk_cache = ChunkCache(64 * 1024 * 1024)
+
+def lookup_content(download_dir, filehash, filesize):
+    """path of a finished download with this hash, if it is still there unchanged in size"""
+    index = _load_content_index(download_dir)
+    path = index.get(filehash)
+    if path and os.path.exists(path) and os.path.getsize(path) == filesize:
+        return path
+    return None
+
+def record_content(download_dir, filehash, path):
+    index = _load_content_index(download_dir)
+    index[filehash] = path
+    tmp_path = os.path.join(download_dir, CONTENT_INDEX + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(download_dir, CONTENT_INDEX))
+
+def _load_content_index(download_dir):
+    if download_dir not in _content_index:
+        try:
+            with open(os.path.join(download_dir, CONTENT_INDEX)) as f:
+                _content_index[download_dir] = json.load(f)
+        except (OSError, ValueError):
+            _content_index[download_dir] = {}
+    return _content_index[download_dir]
+
+class ChunkBitmap:
+    """one bit per chunk, set once that chunk is on disk"""
+    def __init__(self, total_chunks, bits=None):
+        self.total_chunks = total_chunks
+        self.bits = bytearray(bits) if bits is not None else bytearray((total_chunks + 7) // 8)
+        self.count = sum(bin(b).count('1') for b in self.bits)
+
+    def __contains__(self, index):
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def add(self, index):
+        """marks a chunk as received, returns False if it already was"""
+        if not 0 <= index < self.total_chunks or index in self:
+            return False
+        self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+        return True
+
+    @property
+    def complete(self):
+        return self.count == self.total_chunks
+
+    def first_missing(self, start=0):
+        """index of the first chunk at or after start that hasn't arrived"""
+        index = start
+        while index < self.total_chunks:
+            # skip whole bytes of received chunks at once
+            if index & 7 == 0 and self.bits[index >> 3] == 0xFF:
+                index += 8
+                continue
+            if index not in self:
+                return index
+            index += 1
+        return self.total_chunks
+
+    def present_ranges(self):
+        """list of (start, end) ranges of chunks already received"""
+        ranges = []
+        start = 0
+        for missing_start, missing_end in self.missing_ranges() + [(self.total_chunks, self.total_chunks)]:
+            if missing_start > start:
+                ranges.append((start, missing_start))
+            start = missing_end
+        return ranges
+
+    def missing_ranges(self):
+        """list of (start, end) ranges of chunks still missing"""
+        ranges = []
+        index = self.first_missing()
+        while index < self.total_chunks:
+            end = index
+            while end < self.total_chunks and end not in self:
+                end += 1
+            ranges.append((index, end))
+            index = self.first_missing(end)
+        return ranges
+
+class PartialFile:
+    """a download written in place as chunks arrive, in any order"""
+    def __init__(self, path, filesize, chunk_size):
+        self.path = path
+        self.filesize = filesize
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        self.f = open(path, mode)
+        if os.path.getsize(path) != filesize:
+            self.f.truncate(filesize)
+            # reserve the blocks up front where the platform supports it
+            if hasattr(os, 'posix_fallocate') and filesize:
+                try:
+                    os.posix_fallocate(self.f.fileno(), 0, filesize)
+                except OSError:
+                    pass
+
+    def write_chunk(self, index, data):
+        offset = index * self.chunk_size
+        if hasattr(os, 'pwrite'):
+            os.pwrite(self.f.fileno(), data, offset)
+        else:
+            with self.lock:
+                self.f.seek(offset)
+                self.f.write(data)
+
+    def read_chunk(self, index):
+        offset = index * self.chunk_size
+        length = max(min(self.chunk_size, self.filesize - offset), 0)
+        with self.lock:
+            self.f.seek(offset)
+            return self.f.read(length)
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+
+    def finish(self, final_path):
+        """closes the file and moves it to its final name"""
+        self.close()
+        os.replace(self.path, final_path)
+
+def save_progress(partial_path, info, bitmap):
+    """writes the sidecar that lets a download survive a restart"""
+    record = dict(info, bitmap=base64.b64encode(bytes(bitmap.bits)).decode('ascii'),
+                  total_chunks=bitmap.total_chunks)
+    tmp_path = partial_path + PROGRESS_SUFFIX + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_path, partial_path + PROGRESS_SUFFIX)
+
+def remove_progress(partial_path):
+    try:
+        os.remove(partial_path + PROGRESS_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+def find_progress(download_dir, filehash, filesize, exclude=()):
+    """returns (partial_path, record, bitmap) of a saved partial download of this content"""
+    for sidecar in glob.glob(os.path.join(download_dir, '*' + PROGRESS_SUFFIX)):
+        try:
+            with open(sidecar) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            continue
+        partial_path = sidecar[:-len(PROGRESS_SUFFIX)]
+        if partial_path in exclude:
+            continue
+        if (record.get('filehash') == filehash and record.get('filesize') == filesize
+                and os.path.exists(partial_path)):
+            bitmap = ChunkBitmap(record['total_chunks'], base64.b64decode(record['bitmap']))
+            return partial_path, record, bitmap
+    return None
@@ -1,7 +1,9 @@
 import random
 import state
-from network import send_message
+import directory
+from network import reliable, new_message_id, EXACTLY_ONCE
 from parser import build_message
+from registry import register
 
 WINNING_LINES = [
     (0, 1, 2), (3, 4, 5), (6, 7, 8),  # Horizontal
@@ -50,10 +52,10 @@ def initiate_game(sock, my_id, opponent_id, verbose):
         "GAMEID": game_id, 
         "SYMBOL": opponent_symbol, 
         "TIMESTAMP": "9999", 
-        "MESSAGE_ID": "msgidttt1"
+        "MESSAGE_ID": new_message_id()
     }
-    ip = opponent_id.split('@')[1]
-    send_message(sock, build_message(fields), ip, verbose)
+    addr = directory.address(opponent_id)
+    reliable.send(sock, build_message(fields), addr, fields["MESSAGE_ID"], verbose)
     print(f"Tic-Tac-Toe invitation sent to {opponent_id} for game {game_id}.")
     print(f"Waiting for {opponent_id} to make the first move.")
 
@@ -65,65 +67,68 @@ def process_move(cmd, sock, args):
         print("Usage: move <game_id> <position(0-8)>")
         return
     
-    if game_id not in state.tictactoe_games:
+    game = state.tictactoe_games.get(game_id)
+    if game is None:
         print("Error: Invalid game ID.")
         return
-    
-    # error handling
-    game = state.tictactoe_games[game_id]
-    if game['status'] == 'finished':
-        print("Error: This game is already over.")
-        return
-    # if game['turn'] != args.id:
-    #     print("Error: It's not your turn")
-    #     return
-    if not (0 <= position <= 8 and game['board'][position] == ''):
-        print("Error: Invalid or occupied position.")
-        return
-    
-    # update local board and game status
-    game['board'][position] = game['my_symbol']
-    game['status'] = 'active'
-
-    # check win / draw
-    winning_line = check_win(game['board'], game['my_symbol'])
-    if winning_line:
-        result_type = "TICTACTOE_RESULT"
-        result_fields = {
-            "RESULT": "WIN", 
-            "WINNING_LINE": winning_line, 
-            "SYMBOL": game['my_symbol']
-        }
-        print("Game Over!")
-        print_board(game['board'])
-    elif check_draw(game['board']):
-        result_type = "TICTACTOE_RESULT"
-        result_fields = {"RESULT": "DRAW"}
-        print("It's a draw!")
-    else:
-        game['turn'] += 1
-        result_type = "TICTACTOE_MOVE"
-        result_fields = {
-            "POSITION": position, 
-            "SYMBOL": game['my_symbol'],
-            "TURN": game['turn']
-        }
 
+    # the lock keeps a move arriving meanwhile off the board until ours is on it
+    with state.tictactoe_games.lock(game_id):
+        # error handling
+        if game['status'] == 'finished':
+            print("Error: This game is already over.")
+            return
+        # if game['turn'] != args.id:
+        #     print("Error: It's not your turn")
+        #     return
+        if not (0 <= position <= 8 and game['board'][position] == ''):
+            print("Error: Invalid or occupied position.")
+            return
+
+        # update local board and game status
+        game['board'][position] = game['my_symbol']
+        game['status'] = 'active'
+
+        # check win / draw
+        winning_line = check_win(game['board'], game['my_symbol'])
+        if winning_line:
+            result_type = "TICTACTOE_RESULT"
+            result_fields = {
+                "RESULT": "WIN", 
+                "WINNING_LINE": winning_line, 
+                "SYMBOL": game['my_symbol']
+            }
+            print("Game Over!")
+            print_board(game['board'])
+        elif check_draw(game['board']):
+            result_type = "TICTACTOE_RESULT"
+            result_fields = {"RESULT": "DRAW"}
+            print("It's a draw!")
+        else:
+            game['turn'] += 1
+            result_type = "TICTACTOE_MOVE"
+            result_fields = {
+                "POSITION": position, 
+                "SYMBOL": game['my_symbol'],
+                "TURN": game['turn']
+            }
 
     # send message
     fields = {
         "TYPE": result_type, 
         "FROM": args.id, 
         "TO": game['opponent'],
-        "GAMEID": game_id, **result_fields
+        "GAMEID": game_id, **result_fields,
+        "MESSAGE_ID": new_message_id()
     }
-    ip = game['opponent'].split('@')[1]
-    send_message(sock, build_message(fields), ip, args.verbose)
+    addr = directory.address(game['opponent'])
+    reliable.send(sock, build_message(fields), addr, fields["MESSAGE_ID"], args.verbose)
     print_board(game['board'])
 
 # --- handle game messages
 
-def handle_invite(msg):
+@register("TICTACTOE_INVITE", EXACTLY_ONCE)
+def handle_invite(msg, sock, args):
     # --- Start of Changed Code ---
     game_id = msg.get("GAMEID")
     from_id = msg.get("FROM") # person who started the game
@@ -148,13 +153,16 @@ def handle_invite(msg):
     print(f"It is your turn. You are '{my_symbol}'. To move, type: move {game_id} <0-8>")
     print(f"> ", end="", flush=True)
 
-def handle_move(msg):
+@register("TICTACTOE_MOVE", EXACTLY_ONCE)
+def handle_move(msg, sock, args):
     game_id = msg.get("GAMEID")
-    if game_id in state.tictactoe_games:
-        game = state.tictactoe_games[game_id]
+    game = state.tictactoe_games.get(game_id)
+    if game is None:
+        return
+    with state.tictactoe_games.lock(game_id):
         position = int(msg.get("POSITION"))
         symbol = msg.get("SYMBOL")
-        turn = msg.get("TURN")
+        turn = int(msg.get("TURN", 0))
 
         game['board'][position] = symbol
         game['turn'] = turn + 1
@@ -165,10 +173,13 @@ def handle_move(msg):
         print("It's your turn.")
         print(f"> ", end="", flush=True)
 
-def handle_result(msg):
+@register("TICTACTOE_RESULT", EXACTLY_ONCE)
+def handle_result(msg, sock, args):
     game_id = msg.get("GAMEID")
-    if game_id in state.tictactoe_games:
-        game = state.tictactoe_games[game_id]
+    game = state.tictactoe_games.get(game_id)
+    if game is None:
+        return
+    with state.tictactoe_games.lock(game_id):
         result = msg.get("RESULT")
 
         # update board with final move if win
@@ -1,12 +1,198 @@
+"""verbose logging, off the threads that do the work.
+
+log() only checks the level and the sampling of the message's TYPE, then
+queues the record; a background thread formats it (timestamp, truncated
+fields) and writes it to the sink, at most RATE lines a second. a full
+queue or the rate limit drops lines and counts them instead of slowing
+the sender down
+"""
+import atexit
+import queue
+import sys
+import threading
 import time
+from collections import deque
+
+LEVELS = {'debug': 10, 'info': 20, 'warn': 30, 'error': 40, 'off': 100}
+DIRECTION_LEVELS = {'SEND': 10, 'RECV': 10, 'INFO': 20, 'WARN': 30, 'ERROR': 40}
+SAMPLE = {'FILE_CHUNK': 100, 'FILE_ACK': 100}  # TYPE -> log one SEND / RECV of it in this many
+MAX_FIELD = 120       # characters of a field value shown, the rest is summarized (base64 DATA)
+QUEUE_SIZE = 10000    # records waiting for the writer before new ones are dropped
+RATE = 500            # lines written per second at most
+RING_SIZE = 2000      # lines the ring sink keeps
 
 verbose_mode = False
+level = LEVELS['debug']  # records below this are not logged
+type_levels = {}         # TYPE -> its own level, e.g. FILE_CHUNK=warn
+samples = dict(SAMPLE)
+stats = {'written': 0, 'sampled out': 0, 'dropped': 0, 'rate limited': 0}
+
+_seen = {}  # TYPE -> records of it so far, for sampling
+_records = queue.Queue(QUEUE_SIZE)
+_writer = None
+_writer_lock = threading.Lock()
+
+class ConsoleSink:
+    def write(self, lines):
+        sys.stdout.write(''.join(line + '\n' for line in lines))
+        sys.stdout.flush()
+
+    def __str__(self):
+        return "console"
+
+class FileSink:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, lines):
+        self.file.write(''.join(line + '\n' for line in lines))
+        self.file.flush()
+
+    def __str__(self):
+        return f"file {self.path}"
+
+class RingSink:
+    """keeps the last lines in memory, for the log command"""
+    def __init__(self, size=RING_SIZE):
+        self.lines = deque(maxlen=size)
+
+    def write(self, lines):
+        self.lines.extend(lines)
+
+    def __str__(self):
+        return f"ring of {self.lines.maxlen} lines"
+
+sink = ConsoleSink()
 
 def set_verbose(flag):
     global verbose_mode
     verbose_mode = flag
 
-def log(message, direction="INFO"):
-    if verbose_mode:
-        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        print(f"[{ts}] {direction} > {message}")
+def parse_sink(spec):
+    """a sink from --log-sink: console, file:PATH or ring[:LINES]"""
+    kind, _, arg = spec.partition(':')
+    if kind == 'console' and not arg:
+        return ConsoleSink()
+    if kind == 'file' and arg:
+        return FileSink(arg)
+    if kind == 'ring':
+        return RingSink(int(arg) if arg else RING_SIZE)
+    raise ValueError(f"unknown log sink '{spec}', use console, file:PATH or ring[:LINES]")
+
+def configure(new_sink=None, levels=(), sampling=()):
+    """levels and sampling are 'LEVEL' / 'TYPE=LEVEL' and 'TYPE=N' strings, as given on the command line"""
+    global sink, level
+    if new_sink is not None:
+        sink = new_sink
+    for spec in levels:
+        msg_type, _, name = spec.rpartition('=')
+        if name.lower() not in LEVELS:
+            raise ValueError(f"unknown log level '{name}', use one of {', '.join(LEVELS)}")
+        if msg_type:
+            type_levels[msg_type] = LEVELS[name.lower()]
+        else:
+            level = LEVELS[name.lower()]
+    for spec in sampling:
+        msg_type, _, every = spec.partition('=')
+        if not msg_type or not every.isdigit():
+            raise ValueError(f"expected TYPE=N, got '{spec}'")
+        samples[msg_type] = max(int(every), 1)
+
+def log(message, direction="INFO", msg_type=None):
+    """logs message in verbose mode. message may be a function returning the
+    text, then it only runs on the writer thread, if the record is kept at all"""
+    if not verbose_mode:
+        return
+    rank = DIRECTION_LEVELS.get(direction, 20)
+    if rank < type_levels.get(msg_type, level):
+        return
+    every = samples.get(msg_type)
+    # warnings and errors are never sampled out
+    if every and rank < LEVELS['warn']:
+        n = _seen[msg_type] = _seen.get(msg_type, 0) + 1
+        if every > 1 and n % every != 1:
+            stats['sampled out'] += 1
+            return
+    try:
+        _records.put_nowait((time.time(), direction, message))
+    except queue.Full:
+        stats['dropped'] += 1
+        return
+    if _writer is None:
+        _start_writer()
+
+def truncate(text, limit=MAX_FIELD):
+    """text with every field value past limit characters cut short"""
+    if len(text) <= limit:
+        return text
+    lines = []
+    for line in text.split('\n'):
+        if len(line) > limit:
+            line = f"{line[:limit]}... ({len(line) - limit} more)"
+        lines.append(line)
+    return '\n'.join(lines)
+
+def _start_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_loop, daemon=True)
+            _writer.start()
+
+def _write_loop():
+    second = None
+    stamp = ""
+    written = 0
+    while True:
+        records = [_records.get()]
+        while len(records) < 256:
+            try:
+                records.append(_records.get_nowait())
+            except queue.Empty:
+                break
+        lines = []
+        for when, direction, message in records:
+            if int(when) != second:
+                if second is not None and written > RATE:
+                    lines.append(f"[{stamp}] WARN > {written - RATE} log lines over {RATE}/s left out")
+                # strftime once a second rather than per line
+                second, written = int(when), 0
+                stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when))
+            written += 1
+            if written > RATE:
+                stats['rate limited'] += 1
+                continue
+            try:
+                text = message() if callable(message) else message
+            except Exception as e:
+                text = f"<log message failed: {e}>"
+            lines.append(f"[{stamp}] {direction} > {truncate(text)}")
+        try:
+            sink.write(lines)
+            stats['written'] += len(lines)
+        except Exception:
+            stats['dropped'] += len(lines)
+        for _ in records:
+            _records.task_done()
+
+def flush(timeout=1.0):
+    """waits (up to timeout) for queued records to be written, at exit"""
+    deadline = time.time() + timeout
+    while _writer is not None and _records.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.01)
+
+atexit.register(flush)
+
+def report():
+    """a line for stats about the log pipeline, None when not logging"""
+    if not verbose_mode:
+        return None
+    return (f"log ({sink}): {stats['written']} lines written, {stats['sampled out']} sampled out, "
+            f"{stats['rate limited']} over the rate limit, {stats['dropped']} dropped, {_records.qsize()} queued")
+
+def recent(n=50):
+    """the last n lines of the ring sink, None for other sinks"""
+    if not isinstance(sink, RingSink):
+        return None
+    return list(sink.lines)[-n:]